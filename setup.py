@@ -13,9 +13,15 @@ setup(
     install_requires=[
         "singer-python==5.9.0",
         "google-api-python-client==1.7.11",
-        "oauth2client==4.1.3",
+        "google-auth>=1.6.0",
+        "google-auth-httplib2>=0.0.3",
         "backoff==1.8.0"
     ],
+    extras_require={
+        "export": ["pyarrow>=1.0.0"],
+        "streaming": ["requests>=2.20.0", "ijson>=3.0"],
+        "test": ["pytest>=6.0", "pyarrow>=1.0.0", "requests>=2.20.0", "ijson>=3.0"]
+    },
     entry_points="""
     [console_scripts]
     tap-google-analytics=tap_google_analytics:main
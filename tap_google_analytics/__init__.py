@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from datetime import timedelta, date
+import argparse
 import json
 import sys
 import re
@@ -9,8 +10,6 @@ from pathlib import Path
 import singer
 from singer import utils, get_bookmark
 
-from .sync import sync
-from .discover import discover
 from .helpers import *
 from .error import *
 
@@ -37,80 +36,186 @@ def get_end_date(config):
     if 'end_date' in config: return config['end_date']
     return (utils.now() - timedelta(1)).replace(hour=0, minute=0, second=0, microsecond=0)
 
+def parse_serve_args():
+    # The server mode doesn't take a config, so it is parsed before the standard Singer arguments
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--serve', metavar='SOCKET_PATH', help='Run as a server accepting sync jobs on a Unix socket')
+    parser.add_argument('--max-jobs', type=int, default=4, help='Maximum number of concurrent sync jobs in server mode')
+    args, _ = parser.parse_known_args()
+
+    return args
+
 def process_args():
     # Parse command line arguments
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
+    args.config = process_config(args.config)
+
+    return args
 
+def process_config(config):
+    """
+    Validates the config and resolves the values the sync relies on, e.g.
+    start_date and end_date as datetimes.
+    """
     # Check for errors on the provided config params that utils.parse_args is letting through
-    if not args.config.get('start_date'):
+    if not config.get('start_date'):
         LOGGER.critical("tap-google-analytics: a valid start_date must be provided.")
         sys.exit(1)
 
-    if not args.config.get('view_id'):
+    if not config.get('view_id'):
         LOGGER.critical("tap-google-analytics: a valid view_id must be provided.")
         sys.exit(1)
 
-    if not args.config.get('key_file_location') and not args.config.get('oauth_credentials'):
+    if not config.get('key_file_location') and not config.get('oauth_credentials'):
         LOGGER.critical("tap-google-analytics: a valid key_file_location string or oauth_credentials object must be provided.")
         sys.exit(1)
 
     # Remove optional args that have empty strings as values
     # Check if sampling level is defined and valid.
-    if 'sampling_level' in args.config and args.config.get('sampling_level') not in ['DEFAULT', 'SMALL', 'LARGE']:
+    if 'sampling_level' in config and config.get('sampling_level') not in ['DEFAULT', 'SMALL', 'LARGE']:
         LOGGER.warning('tap-google-analytics: Invalid sampling_level, will default to DEFAULT')
-        del args.config['sampling_level']
+        del config['sampling_level']
 
     # Check if lookback days is defined and valid.
-    if 'lookback_days' in args.config and type(args.config.get('lookback_days')) is not int:
+    if 'lookback_days' in config and type(config.get('lookback_days')) is not int:
         LOGGER.warning('tap-google-analytics: Invalid lookback_days, will default to 15')
-        del args.config['lookback_days']
+        del config['lookback_days']
+
+    # Check if the decoding pool settings are defined and valid.
+    if 'decode_workers' in config and type(config.get('decode_workers')) is not int:
+        LOGGER.warning('tap-google-analytics: Invalid decode_workers, will decode responses in the main process')
+        del config['decode_workers']
+
+    if 'decode_chunk_size' in config and (type(config.get('decode_chunk_size')) is not int or config['decode_chunk_size'] < 1):
+        LOGGER.warning('tap-google-analytics: Invalid decode_chunk_size, will default to 10000')
+        del config['decode_chunk_size']
+
+    # Normalise the segments into a list of segment IDs. `segment_id` is kept for
+    # backwards compatibility and can be either a single ID or a list of IDs.
+    segment_ids = config.pop('segment_ids', None) or config.pop('segment_id', None) or []
+    if isinstance(segment_ids, str):
+        segment_ids = [segment_ids]
+    if not isinstance(segment_ids, list) or not all(isinstance(segment_id, str) and segment_id for segment_id in segment_ids):
+        LOGGER.critical("tap-google-analytics: segment_ids must be a list of segment IDs (gaid::xxxxx).")
+        sys.exit(1)
+    config['segment_ids'] = segment_ids
+
+    if 'segment_concurrency' in config and (type(config.get('segment_concurrency')) is not int or config['segment_concurrency'] < 1):
+        LOGGER.warning('tap-google-analytics: Invalid segment_concurrency, will default to 4')
+        del config['segment_concurrency']
+
+    # Check if the deferred retry settings are defined and valid.
+    if 'deferred_retry_attempts' in config and (type(config.get('deferred_retry_attempts')) is not int or config['deferred_retry_attempts'] < 1):
+        LOGGER.warning('tap-google-analytics: Invalid deferred_retry_attempts, will default to 3')
+        del config['deferred_retry_attempts']
+
+    if 'deferred_retry_delay' in config and (type(config.get('deferred_retry_delay')) not in [int, float] or config['deferred_retry_delay'] < 0):
+        LOGGER.warning('tap-google-analytics: Invalid deferred_retry_delay, will default to 30')
+        del config['deferred_retry_delay']
+
+    if 'deferred_retry_max_failures' in config and (type(config.get('deferred_retry_max_failures')) is not int or config['deferred_retry_max_failures'] < 1):
+        LOGGER.warning('tap-google-analytics: Invalid deferred_retry_max_failures, will default to 3')
+        del config['deferred_retry_max_failures']
+
+    # Check if the quota ledger settings are defined and valid.
+    if 'quota_priority' in config and config.get('quota_priority') not in ['catalog', 'most_recent_first']:
+        LOGGER.warning('tap-google-analytics: Invalid quota_priority, will default to catalog')
+        del config['quota_priority']
+
+    for quota_key in ['quota_project_daily_limit', 'quota_view_daily_limit', 'quota_reserve']:
+        if quota_key in config and (type(config.get(quota_key)) is not int or config[quota_key] < 0):
+            LOGGER.critical("tap-google-analytics: {} must be a positive integer.".format(quota_key))
+            sys.exit(1)
+
+    # Check if the state emission settings are defined and valid.
+    for state_key in ['state_emit_every_batches', 'state_emit_every_seconds', 'state_emit_every_records']:
+        if state_key in config and (type(config.get(state_key)) not in [int, float] or config[state_key] <= 0):
+            LOGGER.warning("tap-google-analytics: Invalid {}, it will be ignored".format(state_key))
+            del config[state_key]
 
-    if 'reports' in args.config and not args.config.get('reports'):
-        del args.config['reports']
+    if 'token_refresh_margin' in config and (type(config.get('token_refresh_margin')) is not int or config['token_refresh_margin'] < 0):
+        LOGGER.warning('tap-google-analytics: Invalid token_refresh_margin, will default to 300')
+        del config['token_refresh_margin']
 
-    if 'end_date' in args.config and not args.config.get('end_date'):
-        del args.config['end_date']
+    if 'merge_streams' in config and type(config.get('merge_streams')) is not bool:
+        LOGGER.warning('tap-google-analytics: Invalid merge_streams, will default to true')
+        del config['merge_streams']
 
-    if 'date_batching' in args.config and not args.config.get('date_batching') in ['DAY', 'WEEK', 'MONTH']:
-        del args.config['date_batching']
+    if 'pipeline_queue_size' in config and (type(config.get('pipeline_queue_size')) is not int or config['pipeline_queue_size'] < 0):
+        LOGGER.warning('tap-google-analytics: Invalid pipeline_queue_size, will fetch and write records sequentially')
+        del config['pipeline_queue_size']
+
+    # Check if the page size is defined and valid.
+    if 'page_size' in config and (type(config.get('page_size')) is not int or not 1 <= config['page_size'] <= 100000):
+        LOGGER.warning('tap-google-analytics: Invalid page_size, will default to 100000')
+        del config['page_size']
+
+    # Check that the export mode is valid and has a destination.
+    if 'export_format' in config and not config.get('export_format'):
+        del config['export_format']
+
+    if 'export_format' in config:
+        if config['export_format'] not in ['parquet', 'arrow']:
+            LOGGER.critical("tap-google-analytics: export_format must be one of 'parquet' or 'arrow'.")
+            sys.exit(1)
+
+        if not config.get('export_path'):
+            LOGGER.critical("tap-google-analytics: a valid export_path must be provided when export_format is set.")
+            sys.exit(1)
+
+    # Check that the backfill mode is valid and has a shared directory.
+    if 'backfill_mode' in config and not config.get('backfill_mode'):
+        del config['backfill_mode']
+
+    if 'backfill_mode' in config:
+        if config['backfill_mode'] not in ['plan', 'work', 'merge']:
+            LOGGER.critical("tap-google-analytics: backfill_mode must be one of 'plan', 'work' or 'merge'.")
+            sys.exit(1)
+
+        if not config.get('backfill_dir'):
+            LOGGER.critical("tap-google-analytics: a valid backfill_dir must be provided when backfill_mode is set.")
+            sys.exit(1)
+
+    if 'reports' in config and not config.get('reports'):
+        del config['reports']
+
+    if 'end_date' in config and not config.get('end_date'):
+        del config['end_date']
+
+    if 'date_batching' in config and not config.get('date_batching') in DATE_BATCHING_INTERVALS:
+        del config['date_batching']
 
     # Process the start_date and end_date so that they define an open date window
     # that ends yesterday if end_date is not defined
-    start_date = utils.strptime_to_utc(args.config['start_date'])
-    args.config['start_date'] = start_date
+    start_date = utils.strptime_to_utc(config['start_date'])
+    config['start_date'] = start_date
 
-    end_date = args.config.get('end_date', utils.strftime(utils.now()))
+    end_date = config.get('end_date', utils.strftime(utils.now()))
     end_date = utils.strptime_to_utc(end_date)
     # end_date = utils.strptime_to_utc(end_date) - timedelta(days=1)
     end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    args.config['end_date'] = end_date
+    config['end_date'] = end_date
 
     if end_date < start_date:
         LOGGER.critical("tap-google-analytics: start_date '{}' > end_date '{}'".format(start_date, end_date))
         sys.exit(1)
 
-    date_batching = args.config.get('date_batching', 'DAY')
-    if date_batching == 'DAY':
-        args.config['date_batching'] = 0
-    elif date_batching == 'WEEK':
-        args.config['date_batching'] = 6
-    elif date_batching == 'MONTH':
-        args.config['date_batching'] = 29
+    config['date_batching'] = DATE_BATCHING_INTERVALS[config.get('date_batching', 'DAY')]
 
     # If using a service account, validate that the client_secrets.json file exists and load it
-    if args.config.get('key_file_location'):
-        if Path(args.config['key_file_location']).is_file():
+    if config.get('key_file_location'):
+        if Path(config['key_file_location']).is_file():
             try:
-                args.config['client_secrets'] = load_json(args.config['key_file_location'])
+                config['client_secrets'] = load_json(config['key_file_location'])
             except ValueError:
-                LOGGER.critical("tap-google-analytics: The JSON definition in '{}' has errors".format(args.config['key_file_location']))
+                LOGGER.critical("tap-google-analytics: The JSON definition in '{}' has errors".format(config['key_file_location']))
                 sys.exit(1)
         else:
-            LOGGER.critical("tap-google-analytics: '{}' file not found".format(args.config['key_file_location']))
+            LOGGER.critical("tap-google-analytics: '{}' file not found".format(config['key_file_location']))
             sys.exit(1)
     else:
         # If using oauth credentials, verify that all required keys are present
-        credentials = args.config['oauth_credentials']
+        credentials = config['oauth_credentials']
 
         if not credentials.get('access_token'):
             LOGGER.critical("tap-google-analytics: a valid access_token for the oauth_credentials must be provided.")
@@ -128,13 +233,25 @@ def process_args():
             LOGGER.critical("tap-google-analytics: a valid client_secret for the oauth_credentials must be provided.")
             sys.exit(1)
 
-    return args
+    return config
 
 @utils.handle_top_exception(LOGGER)
 def main():
+    # The sync, discovery and server modules pull in the Google API client, so
+    # they are only imported by the mode that needs them, keeping e.g. --help fast
+
+    # Run as a long running server if requested
+    serve_args = parse_serve_args()
+    if serve_args.serve:
+        from .server import serve
+        serve(serve_args.serve, serve_args.max_jobs)
+        return
+
     # Parse command line arguments
     args = process_args()
 
+    from .discover import discover
+
     # If discover flag was passed, run discovery mode and dump output to stdout
     if args.discover:
         catalog = discover(args.config)
@@ -146,7 +263,12 @@ def main():
         else:
             catalog = discover(args.config)
 
-        sync(args.config, args.state, catalog)
+        if args.config.get('backfill_mode'):
+            from .backfill import backfill
+            backfill(args.config, args.state, catalog)
+        else:
+            from .sync import sync
+            sync(args.config, args.state, catalog)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,316 @@
+import contextlib
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import singer
+from singer import utils, metadata
+
+from .client import Client
+from .discover import Report
+from .error import *
+from .export import Exporter
+from .sync import get_selected_streams, can_sync_stream, get_date_batches, sync_date_batch, get_sync_ranges, add_completed_range, RETRYABLE_ERRORS
+
+LOGGER = singer.get_logger()
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def unit_id(stream_id, view_id, start_date, end_date):
+    # Work unit IDs are deterministic, so planning the same backfill twice gives the same units
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', f'{stream_id}-{view_id}-{start_date}-{end_date}')
+
+
+class Backfill:
+    """
+    Splits a sync into independent work units (stream x view x date batch)
+    that can be run by separate tap processes, on separate nodes, sharing
+    nothing but the `backfill_dir` directory:
+
+      manifest.json       the work units and the catalog entries they need
+      claims/<unit>/      created atomically by the process running a unit
+      output/<unit>.jsonl the Singer messages of a finished unit
+      done/<unit>.json    marks a unit as finished
+
+    Work units are idempotent: the records of a unit are always the same for
+    the same date batch, and an output is only published once complete.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.path = Path(config['backfill_dir'])
+        self.claim_timeout = config.get('backfill_claim_timeout', 3600)
+        # Tells the claims of this process apart, even from an earlier process with the same PID
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+
+    def unit_path(self, kind, unit, suffix=''):
+        return self.path.joinpath(kind, unit['id'] + suffix)
+
+    def load_manifest(self):
+        manifest_path = self.path.joinpath(MANIFEST_FILE)
+        if not manifest_path.is_file():
+            LOGGER.critical(f"tap-google-analytics: no backfill manifest found in '{self.path}', run with backfill_mode 'plan' first.")
+            sys.exit(1)
+
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def plan(self, state, catalog):
+        """
+        Writes the manifest with a work unit for every date batch of every
+        selected stream that isn't completed in state yet.
+        """
+        selected_stream_ids = get_selected_streams(catalog)
+        view_id = self.config['view_id']
+        units = []
+        streams = {}
+
+        for stream in catalog['streams']:
+            stream_id = stream['tap_stream_id']
+            if stream_id not in selected_stream_ids:
+                continue
+
+            report_definition = Report.get_report_definition(stream)
+            stream_config = Report.get_stream_config(self.config, stream)
+
+            if not can_sync_stream(stream_id, report_definition, stream_config):
+                continue
+
+            streams[stream_id] = stream
+            sync_ranges = get_sync_ranges(stream_config, state, stream_id)
+            fixed_date_batching = 'date_batching' in Report.get_overrides(stream)
+            for batch_start_date, batch_end_date in get_date_batches(stream_config, sync_ranges, stream_config['date_batching'], fixed_date_batching):
+                units.append({
+                    'id': unit_id(stream_id, view_id, batch_start_date.strftime('%Y-%m-%d'), batch_end_date.strftime('%Y-%m-%d')),
+                    'stream': stream_id,
+                    'view_id': view_id,
+                    'start_date': batch_start_date.strftime('%Y-%m-%d'),
+                    'end_date': batch_end_date.strftime('%Y-%m-%d'),
+                    'priority': stream_config.get('priority', 0)
+                })
+
+        # Workers claim the units in manifest order, so the streams with a higher priority go first
+        units.sort(key=lambda unit: unit['priority'], reverse=True)
+
+        for directory in ['claims', 'output', 'done']:
+            self.path.joinpath(directory).mkdir(parents=True, exist_ok=True)
+
+        manifest_path = self.path.joinpath(MANIFEST_FILE)
+        with open(manifest_path.with_name(MANIFEST_FILE + '.tmp'), 'w') as f:
+            json.dump({'units': units, 'streams': streams, 'state': state}, f, indent=2)
+        os.replace(manifest_path.with_name(MANIFEST_FILE + '.tmp'), manifest_path)
+
+        LOGGER.info(f'Planned {len(units)} work units for {len(streams)} streams in {manifest_path}')
+
+    def claim(self, unit):
+        """
+        Claims a unit by creating its claim directory, which is atomic on
+        local and network file systems alike. Claims that weren't touched for
+        `backfill_claim_timeout` seconds are considered abandoned.
+        """
+        if self.unit_path('done', unit, '.json').exists():
+            return False
+
+        claim_path = self.unit_path('claims', unit)
+        try:
+            claim_path.mkdir()
+        except FileExistsError:
+            if not self.take_over(unit, claim_path):
+                return False
+
+        try:
+            claim_path.joinpath('owner').write_text(self.owner + '\n')
+        except FileNotFoundError:
+            # Another process took the claim over right after it was created
+            return False
+
+        return True
+
+    def take_over(self, unit, claim_path):
+        """
+        Takes over an abandoned claim. The claim directory is first renamed
+        to a unique name: renames are atomic, so when several processes find
+        the same abandoned claim, only one of them moves it away. The unit is
+        then claimed again like any other unit.
+        """
+        stale_path = claim_path.with_name(f'{claim_path.name}.stale-{uuid.uuid4().hex}')
+        try:
+            if time.time() - claim_path.stat().st_mtime < self.claim_timeout:
+                return False
+
+            os.rename(claim_path, stale_path)
+        except FileNotFoundError:
+            # Another process moved the abandoned claim away first
+            return False
+
+        # Another process may have taken the claim over and claimed the unit
+        # again since the claim was found abandoned, then that's the claim
+        # that was moved away. Give it back.
+        if time.time() - stale_path.stat().st_mtime < self.claim_timeout:
+            with contextlib.suppress(OSError):
+                os.rename(stale_path, claim_path)
+            return False
+
+        LOGGER.warning(f"Taking over the abandoned claim of unit {unit['id']}")
+        shutil.rmtree(stale_path, ignore_errors=True)
+        try:
+            claim_path.mkdir()
+        except FileExistsError:
+            return False
+
+        return True
+
+    def owns_claim(self, unit):
+        try:
+            return self.unit_path('claims', unit).joinpath('owner').read_text().strip() == self.owner
+        except FileNotFoundError:
+            return False
+
+    @contextlib.contextmanager
+    def heartbeat(self, unit):
+        """
+        Touches the claim of a unit every quarter of `backfill_claim_timeout`
+        while it runs, so that units running longer than the timeout aren't
+        taken over by other processes.
+        """
+        claim_path = self.unit_path('claims', unit)
+        stopped = threading.Event()
+
+        def touch_claim():
+            while not stopped.wait(self.claim_timeout / 4):
+                if not self.owns_claim(unit):
+                    # The unit is idempotent, so finishing it anyway is safe
+                    LOGGER.warning(f"Unit {unit['id']} was taken over by another process")
+                    return
+
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(claim_path)
+
+        thread = threading.Thread(target=touch_claim, name='tap-google-analytics-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def release(self, unit):
+        # Claims taken over by another process are left alone
+        if not self.owns_claim(unit):
+            return
+
+        claim_path = self.unit_path('claims', unit)
+        claim_path.joinpath('owner').unlink(missing_ok=True)
+        claim_path.rmdir()
+
+    def work(self):
+        """
+        Runs all the units of the manifest that are not done nor claimed by
+        another process. Returns True if any unit failed.
+        """
+        manifest = self.load_manifest()
+        client = Client(self.config)
+        exporter = Exporter(self.config) if self.config.get('export_format') else None
+        errors_encountered = False
+
+        for unit in manifest['units']:
+            # The units are fetched with the credentials and view of this process' config
+            if str(unit['view_id']) != str(self.config['view_id']):
+                errors_encountered = True
+                LOGGER.error(f"Skipping unit {unit['id']} of view {unit['view_id']}, this process is configured for view {self.config['view_id']}.")
+                continue
+
+            if not self.claim(unit):
+                continue
+
+            stream = manifest['streams'][unit['stream']]
+            report_definition = Report.get_report_definition(stream)
+            schema = Report.get_selected_schema(stream)
+            stream_config = Report.get_stream_config(self.config, stream)
+            key_properties = metadata.get(metadata.to_map(stream['metadata']), (), "table-key-properties")
+            group = {
+                'dimensions': report_definition['dimensions'],
+                'metrics': report_definition['metrics'],
+                'filters': report_definition['filters'],
+                'sampling_level': stream_config.get('sampling_level'),
+                'segment_concurrency': stream_config.get('segment_concurrency'),
+                'streams': [{
+                    'tap_stream_id': unit['stream'],
+                    'schema': schema,
+                    'report_definition': report_definition
+                }]
+            }
+
+            LOGGER.info(f"Running unit {unit['id']}")
+            output_path = self.unit_path('output', unit, '.jsonl')
+            # Unique, in case a process that lost the claim is still running the unit too
+            tmp_output_path = self.unit_path('output', unit, f'.jsonl.{uuid.uuid4().hex}.tmp')
+            try:
+                with self.heartbeat(unit), open(tmp_output_path, 'w') as output, contextlib.redirect_stdout(output):
+                    if exporter is None:
+                        singer.write_schema(unit['stream'], schema, key_properties)
+                    record_count = sync_date_batch(client, exporter, group,
+                                                   utils.strptime_to_utc(unit['start_date']),
+                                                   utils.strptime_to_utc(unit['end_date']),
+                                                   stream_config.get('segment_ids', []))
+
+                os.replace(tmp_output_path, output_path)
+                with open(self.unit_path('done', unit, '.json'), 'w') as f:
+                    json.dump(dict(unit, records=record_count), f)
+            except (GaInvalidArgumentError, *RETRYABLE_ERRORS) as e:
+                # Leave the unit for another process or a later run
+                errors_encountered = True
+                LOGGER.error(f"Unit {unit['id']} failed due to {type(e).__name__}, releasing it.")
+                LOGGER.debug("Error: '{}'.".format(e))
+                tmp_output_path.unlink(missing_ok=True)
+                self.release(unit)
+
+        client.close()
+        if exporter is not None:
+            exporter.write_manifest()
+
+        return errors_encountered
+
+    def merge(self):
+        """
+        Combines the finished units into a single state, by adding them to
+        the completed ranges of their streams. Units that are not finished yet
+        are left as gaps, to be fetched by the next regular sync.
+        """
+        manifest = self.load_manifest()
+        state = manifest.get('state') or {}
+        state['bookmarks'] = state.get('bookmarks', {})
+        done = {path.stem for path in self.path.joinpath('done').glob('*.json')}
+
+        for stream_id in manifest['streams']:
+            units = [unit for unit in manifest['units'] if unit['stream'] == stream_id]
+            finished = [unit for unit in units if unit['id'] in done]
+
+            for unit in finished:
+                add_completed_range(state, [stream_id], utils.strptime_to_utc(unit['start_date']), utils.strptime_to_utc(unit['end_date']), self.config['start_date'])
+
+            LOGGER.info(f'Merged {len(finished)} of {len(units)} units of {stream_id}')
+
+        with open(self.path.joinpath('state.json'), 'w') as f:
+            json.dump(state, f, indent=2)
+        singer.write_state(state)
+
+
+def backfill(config, state, catalog):
+    mode = config['backfill_mode']
+    backfill = Backfill(config)
+
+    if mode == 'plan':
+        backfill.plan(state, catalog)
+    elif mode == 'work':
+        if backfill.work():
+            sys.exit(1)
+    elif mode == 'merge':
+        backfill.merge()
@@ -5,22 +5,34 @@ import json
 import singer
 import socket
 import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
-from google.oauth2 import service_account
-import googleapiclient.discovery
-
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-
-from oauth2client.service_account import ServiceAccountCredentials
-from oauth2client.client import GoogleCredentials
+from googleapiclient.errors import HttpError
 
 from .error import *
+from .quota import QuotaLedger
+from .token_cache import TokenCache
 from .helpers import generate_sdc_record_hash
 
 SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
 
+TOKEN_URI = 'https://oauth2.googleapis.com/token'
+
+MAX_SEGMENTS_PER_REQUEST = 4
+
+BATCH_GET_URI = 'https://analyticsreporting.googleapis.com/v4/reports:batchGet'
+
+USER_AGENT = 'tap-google-analytics (gzip)'
+
+# ijson prefixes of the response objects that are built while streaming a page
+STREAMED_OBJECTS = {
+    'reports.item.columnHeader': 'columnHeader',
+    'reports.item.data.rows.item': 'row'
+}
+
 NON_FATAL_ERRORS = [
   'userRateLimitExceeded',
   'rateLimitExceeded',
@@ -52,7 +64,9 @@ def error_reason(e):
 
 
 def is_fatal_error(error):
-    if isinstance(error, socket.timeout):
+    # Timeouts and dropped connections (including the ones raised by requests
+    # on the streaming path, which are OSErrors) are always retried
+    if isinstance(error, (socket.timeout, OSError)):
         return False
 
     status = error.resp.status if getattr(error, 'resp') is not None else None
@@ -68,33 +82,119 @@ def is_fatal_error(error):
     LOGGER.critical("Received fatal error %s, reason=%s, status=%s", error, reason, status)
     return True
 
+def ga_api_error(e):
+    # Maps an HttpError to the matching GaApiError.
+    # Use list of errors defined in:
+    # https://developers.google.com/analytics/devguides/reporting/core/v4/errors
+    reason = error_reason(e)
+    if reason == 'userRateLimitExceeded' or reason == 'rateLimitExceeded':
+        return GaRateLimitError(e._get_reason())
+    elif reason == 'quotaExceeded':
+        return GaQuotaExceededError(e._get_reason())
+    elif e.resp.status == 400:
+        return GaInvalidArgumentError(e._get_reason())
+    elif e.resp.status in [401, 402]:
+        return GaAuthenticationError(e._get_reason())
+    elif e.resp.status in [500, 503]:
+        return GaBackendServerError(e._get_reason())
+    else:
+        return GaUnknownError(e._get_reason())
+
+def stream_errors():
+    """
+    Returns the errors raised when the connection drops while a streamed
+    response body is read. Besides OSErrors, urllib3 raises its own errors
+    (ProtocolError, ReadTimeoutError, DecodeError), and ijson fails on the
+    truncated JSON.
+    """
+    import ijson
+    import requests
+    import urllib3
+
+    return (OSError, urllib3.exceptions.HTTPError, requests.exceptions.RequestException, ijson.JSONError)
+
+class DiscoveryCache:
+    """
+    In-memory cache of the API discovery documents, for googleapiclient's
+    build(). Without oauth2client, googleapiclient doesn't cache them at all,
+    so every service object built, i.e. one per thread and per sync job of
+    the server, fetched its discovery document over HTTP first.
+    """
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return self.documents.get(url)
+
+    def set(self, url, content):
+        with self.lock:
+            self.documents[url] = content
+
+# Shared by all the Clients of the process
+DISCOVERY_CACHE = DiscoveryCache()
+
+def build_service(service_name, version, credentials):
+    """
+    Builds a googleapiclient service object with its own authorized http
+    transport. The discovery document is fetched once per process.
+    """
+    import googleapiclient.discovery
+
+    return googleapiclient.discovery.build(service_name, version, credentials=credentials, cache=DISCOVERY_CACHE)
+
 class Client:
     def __init__(self, config):
         self.view_id = config.get('view_id')
         self.quota_user = config.get('quota_user', None)
         self.sampling_level = config.get('sampling_level', 'DEFAULT')
+        self.decode_workers = config.get('decode_workers', 0)
+        self.decode_chunk_size = config.get('decode_chunk_size', 10000)
+        self.decode_pool = None
+        self.page_size = config.get('page_size', 100000)
+        self.stream_responses = config.get('stream_responses', False)
+        self.segment_concurrency = config.get('segment_concurrency', 4)
+        self.segment_executors = {}
+        self.lock = threading.Lock()
+        self.quota_ledger = QuotaLedger(config) if config.get('quota_ledger') else None
         self.credentials = self.initialize_credentials(config)
-        self.analytics = self.initialize_analyticsreporting()
+        self.token_cache = TokenCache(config) if config.get('token_cache') else None
+        self.ensure_token()
+        # googleapiclient and its httplib2 transport aren't thread safe, so every
+        # thread that sends requests gets its own service object and http session
+        self.local = threading.local()
+        self.local.analytics = self.initialize_analyticsreporting()
 
         (self.dimensions_ref, self.metrics_ref) = self.fetch_metadata()
 
+    @property
+    def analytics(self):
+        if not hasattr(self.local, 'analytics'):
+            self.local.analytics = self.initialize_analyticsreporting()
+
+        return self.local.analytics
+
     def initialize_credentials(self, config):
+        # The auth and API client libraries are slow to import, so they are only
+        # imported once a Client is needed, not on every run of the CLI
         if 'oauth_credentials' in config:
-            return GoogleCredentials(
-                access_token=config['oauth_credentials']['access_token'],
+            from google.oauth2.credentials import Credentials
+
+            return Credentials(
+                token=config['oauth_credentials']['access_token'],
                 refresh_token=config['oauth_credentials']['refresh_token'],
                 client_id=config['oauth_credentials']['client_id'],
                 client_secret=config['oauth_credentials']['client_secret'],
-                token_expiry=None,  # let the library refresh the token if it is expired
-                token_uri="https://accounts.google.com/o/oauth2/token",
-                user_agent="tap-google-analytics (via singer.io)"
-            )
+                token_uri=TOKEN_URI
+            )  # without an expiry, the token is refreshed once it is rejected
         else:
-            return service_account.Credentials.from_service_account_file(
-                config['key_file_location'],
+            from google.oauth2 import service_account
+
+            return service_account.Credentials.from_service_account_info(
+                config['client_secrets'],
                 scopes=SCOPES
             )
-            # return ServiceAccountCredentials.from_json_keyfile_dict(config['client_secrets'], SCOPES)
 
     def initialize_analyticsreporting(self):
         """Initializes an Analytics Reporting API V4 service object.
@@ -102,8 +202,7 @@ class Client:
         Returns:
             An authorized Analytics Reporting API V4 service object.
         """
-        return googleapiclient.discovery.build('analyticsreporting', 'v4', credentials=self.credentials)
-        # return build('analyticsreporting', 'v4', credentials=self.credentials)
+        return build_service('analyticsreporting', 'v4', self.credentials)
 
     def fetch_metadata(self):
         """
@@ -126,7 +225,7 @@ class Client:
         # This is needed in order to dynamically fetch the metadata for available
         #   metrics and dimensions.
         # (those are not provided in the Analytics Reporting API V4)
-        service = build('analytics', 'v3', credentials=self.credentials)
+        service = build_service('analytics', 'v3', self.credentials)
 
         results = service.metadata().columns().list(reportType='ga', quotaUser=self.quota_user).execute()
 
@@ -185,45 +284,100 @@ class Client:
 
         return data_type
 
-    def process_stream(self, start_date, end_date, stream, segment_id):
+    def process_stream(self, start_date, end_date, stream, segment_ids=None, report_status=None):
+        records = []
+
+        for results in self.iterate_stream_pages(start_date, end_date, stream, segment_ids, report_status):
+            records.extend(results)
+
+        return records
+
+    def iterate_stream_pages(self, start_date, end_date, stream, segment_ids=None, report_status=None):
+        """
+        Yields the processed records of a report one response page at a time,
+        so that callers which write pages straight out don't need to hold the
+        whole date batch in memory. The isDataGolden flag of every page is
+        collected in `report_status`, if given.
+
+        The API accepts up to 4 segments per request. Longer segment lists are
+        split into chunks that are fetched concurrently, and their pages are
+        yielded in the order of the segment list.
+        """
+        segment_chunks = [segment_ids[i:i + MAX_SEGMENTS_PER_REQUEST] for i in range(0, len(segment_ids or []), MAX_SEGMENTS_PER_REQUEST)]
+
+        if len(segment_chunks) <= 1:
+            yield from self.iterate_report_pages(start_date, end_date, stream, segment_chunks[0] if segment_chunks else None, report_status)
+            return
+
+        executor = self.get_segment_executor(stream.get('segment_concurrency') or self.segment_concurrency)
+        futures = [
+            executor.submit(list, self.iterate_report_pages(start_date, end_date, stream, segment_chunk, report_status))
+            for segment_chunk in segment_chunks
+        ]
+        for future in futures:
+            yield from future.result()
+
+    def get_segment_executor(self, segment_concurrency):
+        """
+        Returns the thread pool fetching segment chunks concurrently, with up
+        to `segment_concurrency` threads. Pools live as long as the Client, so
+        every date batch reuses the same threads, along with the service
+        object and http session each of them built.
+        """
+        with self.lock:
+            if segment_concurrency not in self.segment_executors:
+                self.segment_executors[segment_concurrency] = ThreadPoolExecutor(
+                    max_workers=segment_concurrency,
+                    thread_name_prefix='tap-google-analytics-segments'
+                )
+
+            return self.segment_executors[segment_concurrency]
+
+    def iterate_report_pages(self, start_date, end_date, stream, segment_ids, report_status=None):
+        """
+        Yields the processed records of a single report request one page at a
+        time. With `stream_responses` enabled, pages are parsed incrementally
+        from the response body and yielded in chunks of `decode_chunk_size`
+        records.
+        """
         try:
-            records = []
             report_definition = self.generate_report_definition(stream)
             nextPageToken = None
 
             while True:
-                single_response = self.query_api(start_date, end_date, report_definition, nextPageToken, segment_id)
-                (nextPageToken, results) = self.process_response(start_date, end_date, single_response)
-                records.extend(results)
+                if self.stream_responses:
+                    page = ReportPage()
+                    yield from self.stream_response(start_date, end_date, report_definition, nextPageToken, segment_ids, page)
+                    nextPageToken = page.next_page_token
+                    is_data_golden = page.is_data_golden
+                else:
+                    single_response = self.query_api(start_date, end_date, report_definition, nextPageToken, segment_ids)
+                    (nextPageToken, results) = self.process_response(start_date, end_date, single_response)
+                    report = next(iter(single_response.get('reports', [])), {})
+                    is_data_golden = report.get('data', {}).get('isDataGolden')
+                    yield results
+
+                if report_status is not None:
+                    report_status.page_fetched(is_data_golden)
 
                 # Keep on looping as long as we have a nextPageToken
                 if nextPageToken is None:
                     break
-
-            return records
         except HttpError as e:
-            # Process API errors
-            # Use list of errors defined in:
-            # https://developers.google.com/analytics/devguides/reporting/core/v4/errors
-
-            reason = error_reason(e)
-            if reason == 'userRateLimitExceeded' or reason == 'rateLimitExceeded':
-                raise GaRateLimitError(e._get_reason())
-            elif reason == 'quotaExceeded':
-                raise GaQuotaExceededError(e._get_reason())
-            elif e.resp.status == 400:
-                raise GaInvalidArgumentError(e._get_reason())
-            elif e.resp.status in [401, 402]:
-                raise GaAuthenticationError(e._get_reason())
-            elif e.resp.status in [500, 503]:
-                raise GaBackendServerError(e._get_reason())
-            else:
-                raise GaUnknownError(e._get_reason())
+            raise ga_api_error(e)
+        except Exception as e:
+            # The connection dropped while the page was being streamed.
+            # Records have already been yielded, so the page can't be retried here.
+            if isinstance(e, OSError) or (self.stream_responses and isinstance(e, stream_errors())):
+                raise GaBackendServerError(str(e))
+            raise
 
     def generate_report_definition(self, stream):
         report_definition = {
             'metrics': [],
-            'dimensions': []
+            'dimensions': [],
+            'filters': stream.get('filters', {}),
+            'sampling_level': stream.get('sampling_level') or self.sampling_level
         }
 
         for dimension in stream['dimensions']:
@@ -234,37 +388,147 @@ class Client:
 
         return report_definition
 
-    @backoff.on_exception(backoff.expo,
-                          (HttpError, socket.timeout),
-                          max_tries=10,
-                          giveup=is_fatal_error)
-    def query_api(self, start_date, end_date, report_definition, pageToken=None, segment_id=None):
-        """Queries the Analytics Reporting API V4.
-
-        Returns:
-            The Analytics Reporting API V4 response.
-        """
+    def build_request_body(self, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
         request_body = {
             'reportRequests': [
             {
                 'viewId': self.view_id,
                 'dateRanges': [{'startDate': start_date.strftime("%Y-%m-%d"), 'endDate': end_date.strftime("%Y-%m-%d")}],
-                'samplingLevel': self.sampling_level,
-                'pageSize': '100000',
+                'samplingLevel': report_definition.get('sampling_level', self.sampling_level),
+                'pageSize': str(self.page_size),
                 'pageToken': pageToken,
                 'metrics': report_definition['metrics'],
                 'dimensions': report_definition['dimensions']
             }]
         }
-        if segment_id:
-            request_body['reportRequests'][0]['segments'] = [{
-                'segmentId': segment_id
-            }]
+        # Filters are applied by the API, so the rows they exclude are never sent
+        request_body['reportRequests'][0].update(report_definition.get('filters', {}))
+        if segment_ids:
+            request_body['reportRequests'][0]['segments'] = [
+                {'segmentId': segment_id} for segment_id in segment_ids
+            ]
+        return request_body
+
+    @backoff.on_exception(backoff.expo,
+                          (HttpError, socket.timeout),
+                          max_tries=10,
+                          giveup=is_fatal_error)
+    def query_api(self, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
+        """Queries the Analytics Reporting API V4.
+
+        Returns:
+            The Analytics Reporting API V4 response.
+        """
+        self.record_request()
         return self.analytics.reports().batchGet(
-            body=request_body,
+            body=self.build_request_body(start_date, end_date, report_definition, pageToken, segment_ids),
             quotaUser=self.quota_user
         ).execute()
 
+    def record_request(self):
+        # Every attempt counts towards the quota, including the ones retried by the backoff
+        if self.quota_ledger is not None:
+            self.quota_ledger.record_request()
+
+        self.ensure_token()
+
+    def ensure_token(self):
+        # Proactively swaps in a fresh access token from the shared cache before it expires
+        if self.token_cache is not None:
+            self.token_cache.ensure_token(self.credentials)
+
+    def get_http_session(self):
+        if not hasattr(self.local, 'http_session'):
+            try:
+                import requests
+            except ImportError:
+                LOGGER.critical("tap-google-analytics: stream_responses requires the requests and ijson packages. Install them with `pip install tap-google-analytics[streaming]`.")
+                sys.exit(1)
+
+            self.local.http_session = requests.Session()
+
+        return self.local.http_session
+
+    def authorization_headers(self, refresh=False):
+        import google.auth.transport.requests
+
+        headers = {}
+        if refresh or not self.credentials.valid:
+            self.credentials.refresh(google.auth.transport.requests.Request(self.get_http_session()))
+        self.credentials.apply(headers)
+
+        return headers
+
+    @backoff.on_exception(backoff.expo,
+                          (HttpError, OSError),
+                          max_tries=10,
+                          giveup=is_fatal_error)
+    def open_response_stream(self, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
+        """
+        Sends a batchGet request asking for a gzip compressed response and
+        returns the undecoded response body as a file-like object.
+
+        Only the request and the response status are covered by the backoff,
+        the body is read by the caller.
+        """
+        self.record_request()
+        request_body = self.build_request_body(start_date, end_date, report_definition, pageToken, segment_ids)
+        response = self.post_report_request(request_body, self.authorization_headers())
+
+        if response.status_code == 401:
+            # The access token from an OAuth config has no known expiry, so it
+            # is only found to be stale once the API rejects it. Like the
+            # googleapiclient transport, refresh it and try once more.
+            response.close()
+            response = self.post_report_request(request_body, self.authorization_headers(refresh=True))
+
+        if response.status_code >= 400:
+            import httplib2
+
+            # Raise the same error as googleapiclient does, so that the backoff
+            # and the error handling behave exactly like query_api
+            raise HttpError(httplib2.Response({'status': response.status_code}), response.content, uri=BATCH_GET_URI)
+
+        # Let urllib3 transparently gunzip the body while it's being parsed
+        response.raw.decode_content = True
+        return response.raw
+
+    def post_report_request(self, request_body, headers):
+        # Google only compresses the responses when the User-Agent asks for it too
+        headers['Accept-Encoding'] = 'gzip'
+        headers['User-Agent'] = USER_AGENT
+        params = {'quotaUser': self.quota_user} if self.quota_user else {}
+
+        return self.get_http_session().post(BATCH_GET_URI, params=params, json=request_body, headers=headers, stream=True)
+
+    def stream_response(self, start_date, end_date, report_definition, pageToken, segment_ids, page):
+        """
+        Parses a single response page incrementally and yields its records in
+        chunks, without ever holding the raw body or the parsed page in memory.
+        The nextPageToken and isDataGolden flags are stored on `page`.
+        """
+        import ijson
+
+        body = self.open_response_stream(start_date, end_date, report_definition, pageToken, segment_ids)
+        decoder_args = None
+        rows = []
+
+        for kind, value in iterate_report_events(ijson.parse(body)):
+            if kind == 'columnHeader':
+                decoder_args = self.get_decoder_args(start_date, end_date, value)
+            elif kind == 'row':
+                rows.append(value)
+                if len(rows) >= self.decode_chunk_size:
+                    yield decode_rows(rows, *decoder_args)
+                    rows = []
+            elif kind == 'nextPageToken':
+                page.next_page_token = value
+            elif kind == 'isDataGolden':
+                page.is_data_golden = value
+
+        if rows:
+            yield decode_rows(rows, *decoder_args)
+
     def process_response(self, start_date, end_date, response):
         """Processes the Analytics Reporting API V4 response.
 
@@ -283,61 +547,188 @@ class Client:
                ... ... ...
              ]
         """
-        start_date_string = start_date.isoformat()
-        end_date_string = end_date.isoformat()
-        results = []
-
-        try:
-            # We always request one report at a time
-            report = next(iter(response.get('reports', [])), None)
+        # We always request one report at a time
+        report = next(iter(response.get('reports', [])), None)
+        if report is None:
+            return (None, [])
 
-            columnHeader = report.get('columnHeader', {})
-            dimensionHeaders = columnHeader.get('dimensions', [])
-            metricHeaders = columnHeader.get('metricHeader', {}).get('metricHeaderEntries', [])
+        decoder_args = self.get_decoder_args(start_date, end_date, report.get('columnHeader', {}))
+        rows = report.get('data', {}).get('rows', [])
+        pool = self.get_decode_pool()
 
-            for row in report.get('data', {}).get('rows', []):
-                record = {}
-                dimensions = row.get('dimensions', [])
-                dateRangeValues = row.get('metrics', [])
+        if pool is None or len(rows) <= self.decode_chunk_size:
+            results = decode_rows(rows, *decoder_args)
+        else:
+            chunks = [rows[i:i + self.decode_chunk_size] for i in range(0, len(rows), self.decode_chunk_size)]
+            results = []
+            # Executor.map returns the chunks in submission order, so records keep the API row order
+            for decoded in pool.map(decode_rows, chunks, *[[arg] * len(chunks) for arg in decoder_args]):
+                results.extend(decoded)
 
-                for header, dimension in zip(dimensionHeaders, dimensions):
-                    data_type = self.lookup_data_type('dimension', header)
+        return (report.get('nextPageToken'), results)
 
-                    if data_type == 'integer':
-                        value = int(dimension)
-                    elif data_type == 'number':
-                        value = float(dimension)
-                    else:
-                        value = dimension
+    def get_decoder_args(self, start_date, end_date, columnHeader):
+        """
+        Returns the arguments of decode_rows() (after the rows) for a report's
+        columnHeader. The data types are resolved once per page instead of
+        once per cell.
+        """
+        dimensionHeaders = columnHeader.get('dimensions', [])
+        metricHeaders = [header.get('name') for header in columnHeader.get('metricHeader', {}).get('metricHeaderEntries', [])]
+
+        return (
+            self.view_id,
+            dimensionHeaders,
+            [self.lookup_data_type('dimension', header) for header in dimensionHeaders],
+            metricHeaders,
+            [self.lookup_data_type('metric', header) for header in metricHeaders],
+            start_date.isoformat(),
+            end_date.isoformat()
+        )
+
+    def get_decode_pool(self):
+        """
+        Returns the process pool used to decode large pages, or None if
+        `decode_workers` is not configured. The pool is created lazily so
+        that discovery and small syncs never pay for spawning workers.
+
+        Segment threads can decode pages at the same time, so the pool is
+        created under the Client lock. Workers are started by a forkserver
+        rather than forked, since forking a process that already runs
+        threads can copy locks held by those threads into the workers.
+        """
+        if self.decode_workers < 2:
+            return None
+
+        with self.lock:
+            if self.decode_pool is None:
+                self.decode_pool = ProcessPoolExecutor(
+                    max_workers=self.decode_workers,
+                    mp_context=multiprocessing.get_context('forkserver')
+                )
+
+            return self.decode_pool
+
+    def close(self):
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+            self.decode_pool = None
+
+        for executor in self.segment_executors.values():
+            executor.shutdown()
+        self.segment_executors = {}
+
+
+class ReportStatus:
+    """
+    Report level values collected over all the pages, and all the segment
+    requests, of a date batch.
+    """
+    def __init__(self):
+        self.golden_pages = []
+
+    def page_fetched(self, is_data_golden):
+        # list.append is atomic, so pages fetched concurrently can report here
+        self.golden_pages.append(bool(is_data_golden))
+
+    @property
+    def is_data_golden(self):
+        # GA leaves out isDataGolden unless it is true
+        return bool(self.golden_pages) and all(self.golden_pages)
+
+
+class ReportPage:
+    """Page level values of a streamed response, filled in while it's parsed."""
+    def __init__(self):
+        self.next_page_token = None
+        self.is_data_golden = None
+
+
+def iterate_report_events(parser):
+    """
+    Turns the ijson event stream of a batchGet response into
+    ('columnHeader', dict), ('row', dict), ('nextPageToken', str) and
+    ('isDataGolden', bool) tuples for the first report of the response.
+
+    Only a single row is ever materialised at a time.
+    """
+    from ijson.common import ObjectBuilder
+
+    builder = None
+    builder_kind = None
+    builder_prefix = None
+
+    for prefix, event, value in parser:
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event == 'end_map':
+                yield builder_kind, builder.value
+                builder = None
+            continue
+
+        if event == 'start_map' and prefix in STREAMED_OBJECTS:
+            builder = ObjectBuilder()
+            builder.event(event, value)
+            builder_kind = STREAMED_OBJECTS[prefix]
+            builder_prefix = prefix
+        elif prefix == 'reports.item.nextPageToken':
+            yield 'nextPageToken', value
+        elif prefix == 'reports.item.data.isDataGolden':
+            yield 'isDataGolden', value
+        elif prefix == 'reports.item' and event == 'end_map':
+            # We always request one report at a time
+            return
+
+
+def decode_rows(rows, view_id, dimension_headers, dimension_types, metric_headers, metric_types, start_date_string, end_date_string):
+    """
+    Converts raw report rows to records: casts the values to their data types,
+    renames the headers (ga:date > ga_date) and adds the report dates and the
+    record hash.
+
+    This is a module level function with plain arguments so that it can be
+    shipped to the worker processes of the decode pool.
+    """
+    results = []
+    has_date_dimension = 'ga:date' in dimension_headers
+    dimension_keys = [(header.replace("ga:","ga_"), data_type) for header, data_type in zip(dimension_headers, dimension_types)]
+    metric_keys = [(header.replace("ga:","ga_"), data_type) for header, data_type in zip(metric_headers, metric_types)]
+
+    for row in rows:
+        record = {}
+        dimensions = row.get('dimensions', [])
+
+        for (key, data_type), dimension in zip(dimension_keys, dimensions):
+            if data_type == 'integer':
+                value = int(dimension)
+            elif data_type == 'number':
+                value = float(dimension)
+            else:
+                value = dimension
 
-                    record[header.replace("ga:","ga_")] = value
+            record[key] = value
 
-                for i, values in enumerate(dateRangeValues):
-                    for metricHeader, value in zip(metricHeaders, values.get('values')):
-                        metric_name = metricHeader.get('name')
-                        metric_type = self.lookup_data_type('metric', metric_name)
+        for values in row.get('metrics', []):
+            for (key, data_type), value in zip(metric_keys, values.get('values')):
+                if data_type == 'integer':
+                    value = int(value)
+                elif data_type == 'number':
+                    value = float(value)
 
-                        if metric_type == 'integer':
-                            value = int(value)
-                        elif metric_type == 'number':
-                            value = float(value)
+                record[key] = value
 
-                        record[metric_name.replace("ga:","ga_")] = value
+        # Also add the [start_date,end_date] used for the report
+        record['report_start_date'] = start_date_string
+        record['report_end_date'] = end_date_string
 
-                # Also add the [start_date,end_date] used for the report
-                record['report_start_date'] = start_date_string
-                record['report_end_date'] = end_date_string
-                
-                # If there is no date within requested dimensions, append the report_start_date to the dimensionHeaders
-                # to make sure that the record hash includes a unique report timestamp
-                if 'ga:date' not in dimensionHeaders:
-                    dimensions.append(start_date_string)
+        # If there is no date within requested dimensions, append the report_start_date to the dimensionHeaders
+        # to make sure that the record hash includes a unique report timestamp
+        if not has_date_dimension:
+            dimensions.append(start_date_string)
 
-                record['_sdc_record_hash'] = generate_sdc_record_hash(self.view_id, dimensions)
-                record['_sdc_record_timestamp'] = datetime.now().isoformat()
+        record['_sdc_record_hash'] = generate_sdc_record_hash(view_id, dimensions)
+        record['_sdc_record_timestamp'] = datetime.now().isoformat()
 
-                results.append(record)
+        results.append(record)
 
-            return (report.get('nextPageToken'), results)
-        except StopIteration:
-            return (None, [])
+    return results
@@ -13,7 +13,18 @@ from .client import Client
 
 LOGGER = singer.get_logger()
 
-def discover(config):
+# Report definition properties that are passed as-is to the API to filter the rows server side
+FILTER_PROPERTIES = ['dimensionFilterClauses', 'metricFilterClauses', 'filtersExpression']
+
+DIMENSION_FILTER_OPERATORS = ['REGEXP', 'BEGINS_WITH', 'ENDS_WITH', 'PARTIAL', 'EXACT',
+                              'NUMERIC_EQUAL', 'NUMERIC_GREATER_THAN', 'NUMERIC_LESS_THAN', 'IN_LIST']
+
+METRIC_FILTER_OPERATORS = ['EQUAL', 'LESS_THAN', 'GREATER_THAN', 'IS_MISSING']
+
+# Config settings that a report definition can override for its own stream
+OVERRIDE_PROPERTIES = ['date_batching', 'sampling_level', 'lookback_days', 'segment_ids', 'segment_concurrency', 'priority']
+
+def discover(config, client=None):
     # Load the reports json file
     default_reports = Path(__file__).parent.joinpath('defaults', 'default_report_definition.json')
 
@@ -29,17 +40,17 @@ def discover(config):
         sys.exit(1)
 
     # validate the definition
-    report = Report(config, reports_definition)
+    report = Report(config, reports_definition, client)
     report.validate()
 
     # Generate and return the catalog
     return report.generate_catalog()
 
 class Report:
-    def __init__(self, config, reports_definition):
+    def __init__(self, config, reports_definition, client=None):
         self.reports_definition = reports_definition
         # Fetch the valid (dimension, metric) names and their types from GAClient
-        self.client = Client(config)
+        self.client = client or Client(config)
 
     def generate_catalog(self):
         catalog = {
@@ -98,9 +109,10 @@ class Report:
                     "type": ["null", data_type],
                 }
 
+                # Metrics can be deselected, dimensions can't as they define the grain of the report
                 metadata.append({
                     "metadata": {
-                        "inclusion": "automatic",
+                        "inclusion": "available",
                         "selected-by-default": True,
                         "ga_type": 'metric'
                     },
@@ -118,6 +130,14 @@ class Report:
                 "breadcrumb": []
             }
 
+            filters = {key: report[key] for key in FILTER_PROPERTIES if key in report}
+            if filters:
+                stream_metadata['metadata']['ga_filters'] = filters
+
+            overrides = {key: report[key] for key in OVERRIDE_PROPERTIES if key in report}
+            if overrides:
+                stream_metadata['metadata']['ga_overrides'] = overrides
+
             metadata.insert(0, stream_metadata)
 
             catalog_entry = {
@@ -154,6 +174,8 @@ class Report:
 
             self.validate_dimensions(dimensions)
             self.validate_metrics(metrics)
+            self.validate_filters(report)
+            self.validate_overrides(report)
 
     def validate_dimensions(self, dimensions):
         # check that all the dimensions are proper Google Analytics Dimensions
@@ -179,22 +201,154 @@ class Report:
                 LOGGER.info("For details see https://developers.google.com/analytics/devguides/reporting/core/dimsmets")
                 sys.exit(1)
 
+    def validate_filters(self, report):
+        # check that the filters are well formed and only filter on proper Google Analytics fields
+        name = report['name']
+
+        if 'filtersExpression' in report and (not isinstance(report['filtersExpression'], str) or not report['filtersExpression']):
+            LOGGER.critical("'{}' has an invalid filtersExpression. It must be a non-empty string.".format(name))
+            sys.exit(1)
+
+        for clauses_key, name_key, operators in [
+            ('dimensionFilterClauses', 'dimensionName', DIMENSION_FILTER_OPERATORS),
+            ('metricFilterClauses', 'metricName', METRIC_FILTER_OPERATORS)
+        ]:
+            clauses = report.get(clauses_key, [])
+            if not isinstance(clauses, list) or not all(isinstance(clause, dict) for clause in clauses):
+                LOGGER.critical("'{}' has invalid {}. It must be a list of filter clauses.".format(name, clauses_key))
+                sys.exit(1)
+
+            for clause in clauses:
+                if clause.get('operator', 'OR') not in ['OR', 'AND']:
+                    LOGGER.critical("'{}' has an invalid {} operator '{}'. It must be OR or AND.".format(name, clauses_key, clause['operator']))
+                    sys.exit(1)
+
+                filters = clause.get('filters')
+                if not isinstance(filters, list) or not filters or not all(isinstance(f, dict) and f.get(name_key) for f in filters):
+                    LOGGER.critical("'{}' has invalid {}. Every clause needs a list of filters with a {}.".format(name, clauses_key, name_key))
+                    sys.exit(1)
+
+                for f in filters:
+                    if 'operator' in f and f['operator'] not in operators:
+                        LOGGER.critical("'{}' has an invalid {} filter operator '{}'.".format(name, clauses_key, f['operator']))
+                        sys.exit(1)
+
+                if clauses_key == 'dimensionFilterClauses':
+                    self.validate_dimensions([f['dimensionName'] for f in filters])
+                else:
+                    self.validate_metrics([f['metricName'] for f in filters])
+
+    @staticmethod
+    def validate_overrides(report):
+        # check that the settings overridden for this report are valid
+        name = report['name']
+
+        if 'date_batching' in report and report['date_batching'] not in DATE_BATCHING_INTERVALS:
+            LOGGER.critical("'{}' has an invalid date_batching. It must be one of DAY, WEEK or MONTH.".format(name))
+            sys.exit(1)
+
+        if 'sampling_level' in report and report['sampling_level'] not in ['DEFAULT', 'SMALL', 'LARGE']:
+            LOGGER.critical("'{}' has an invalid sampling_level. It must be one of DEFAULT, SMALL or LARGE.".format(name))
+            sys.exit(1)
+
+        if 'lookback_days' in report and (type(report['lookback_days']) is not int or report['lookback_days'] < 0):
+            LOGGER.critical("'{}' has an invalid lookback_days. It must be a positive integer.".format(name))
+            sys.exit(1)
+
+        segment_ids = report.get('segment_ids', [])
+        if isinstance(segment_ids, str):
+            segment_ids = [segment_ids]
+        if not isinstance(segment_ids, list) or not all(isinstance(segment_id, str) and segment_id for segment_id in segment_ids):
+            LOGGER.critical("'{}' has invalid segment_ids. It must be a list of segment IDs (gaid::xxxxx).".format(name))
+            sys.exit(1)
+
+        if 'segment_concurrency' in report and (type(report['segment_concurrency']) is not int or report['segment_concurrency'] < 1):
+            LOGGER.critical("'{}' has an invalid segment_concurrency. It must be an integer of at least 1.".format(name))
+            sys.exit(1)
+
+        if 'priority' in report and type(report['priority']) is not int:
+            LOGGER.critical("'{}' has an invalid priority. It must be an integer.".format(name))
+            sys.exit(1)
+
+    @staticmethod
+    def get_stream_config(config, stream):
+        """
+        Returns the config to sync a stream with: the tap config, with the
+        overrides of the stream's report definition applied.
+
+        The overrides are validated again, as they can be edited in the
+        catalog after discovery.
+        """
+        overrides = Report.get_overrides(stream)
+        name = stream['tap_stream_id']
+
+        if not isinstance(overrides, dict) or not set(overrides) <= set(OVERRIDE_PROPERTIES):
+            LOGGER.critical("'{}' has invalid ga_overrides in the catalog. Only {} can be overridden.".format(name, ', '.join(OVERRIDE_PROPERTIES)))
+            sys.exit(1)
+        Report.validate_overrides(dict(overrides, name=name))
+
+        stream_config = dict(config, **overrides)
+
+        if 'date_batching' in overrides:
+            stream_config['date_batching'] = DATE_BATCHING_INTERVALS[overrides['date_batching']]
+
+        if isinstance(stream_config.get('segment_ids'), str):
+            stream_config['segment_ids'] = [stream_config['segment_ids']]
+
+        return stream_config
+
+    @staticmethod
+    def get_overrides(stream):
+        # The settings the report definition of a stream overrides
+        stream_metadata = singer.metadata.to_map(stream['metadata'])
+
+        return singer.metadata.get(stream_metadata, (), "ga_overrides") or {}
+
     @staticmethod
     def get_report_definition(stream):
+        stream_metadata = singer.metadata.to_map(stream['metadata'])
+
         report = {
             "name" : stream['tap_stream_id'],
             "dimensions" : [],
-            "metrics" : []
+            "metrics" : [],
+            "filters" : singer.metadata.get(stream_metadata, (), "ga_filters") or {}
         }
 
-        stream_metadata = singer.metadata.to_map(stream['metadata'])
-
         for attribute in stream['schema']['properties'].keys():
             ga_type = singer.metadata.get(stream_metadata, ('properties', attribute), "ga_type")
 
             if ga_type == 'dimension':
                 report['dimensions'].append(attribute)
-            elif ga_type == 'metric':
+            elif ga_type == 'metric' and Report.is_field_selected(stream_metadata, attribute):
                 report['metrics'].append(attribute)
 
-        return report
\ No newline at end of file
+        return report
+
+    @staticmethod
+    def is_field_selected(stream_metadata, attribute):
+        breadcrumb = ('properties', attribute)
+
+        return singer.utils.should_sync_field(
+            singer.metadata.get(stream_metadata, breadcrumb, "inclusion"),
+            singer.metadata.get(stream_metadata, breadcrumb, "selected"),
+            singer.metadata.get(stream_metadata, breadcrumb, "selected-by-default") or False
+        )
+
+    @staticmethod
+    def get_selected_schema(stream):
+        """
+        Returns the schema of a stream without the metrics that are deselected
+        in the catalog, as they are left out of the query.
+        """
+        stream_metadata = singer.metadata.to_map(stream['metadata'])
+        schema = dict(stream['schema'])
+
+        schema['properties'] = {
+            attribute: property_schema
+            for attribute, property_schema in stream['schema']['properties'].items()
+            if singer.metadata.get(stream_metadata, ('properties', attribute), "ga_type") != 'metric'
+              or Report.is_field_selected(stream_metadata, attribute)
+        }
+
+        return schema
\ No newline at end of file
@@ -0,0 +1,178 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import singer
+
+LOGGER = singer.get_logger()
+
+EXPORT_FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+
+class ManifestMessage:
+    """
+    Singer-style message listing the files written by an export run.
+
+    It is written with singer.write_message, so it follows the same
+    line-delimited JSON format as the STATE messages around it.
+    """
+    def __init__(self, export_format, export_path, streams):
+        self.export_format = export_format
+        self.export_path = export_path
+        self.streams = streams
+
+    def asdict(self):
+        return {
+            'type': 'MANIFEST',
+            'format': self.export_format,
+            'path': self.export_path,
+            'streams': self.streams
+        }
+
+
+class Exporter:
+    """
+    Writes date batches straight to partitioned Parquet or Arrow IPC files
+    instead of emitting RECORD messages.
+
+    Files are laid out as:
+      <export_path>/<stream_id>/report_start_date=<YYYY-MM-DD>/<start>_<end>.<ext>
+
+    Each response page is written as its own row group, so memory usage is
+    bounded by the page size rather than by the size of the date batch.
+    """
+    def __init__(self, config):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            LOGGER.critical("tap-google-analytics: export_format requires the pyarrow package. Install it with `pip install tap-google-analytics[export]`.")
+            sys.exit(1)
+
+        self.pa = pyarrow
+        self.export_format = config['export_format']
+        self.export_path = config['export_path']
+        self.extension = EXPORT_FORMATS[self.export_format]
+        self.schemas = {}
+        self.manifest = {}
+
+    def arrow_type(self, property_schema):
+        types = property_schema.get('type', [])
+        if isinstance(types, str):
+            types = [types]
+
+        if 'integer' in types:
+            return self.pa.int64()
+        elif 'number' in types:
+            return self.pa.float64()
+
+        return self.pa.string()
+
+    def arrow_schema(self, stream_id, stream_schema):
+        # Column types follow the catalog schema generated by Report.generate_catalog
+        if stream_id not in self.schemas:
+            self.schemas[stream_id] = self.pa.schema([
+                self.pa.field(name, self.arrow_type(property_schema), nullable=True)
+                for name, property_schema in stream_schema['properties'].items()
+            ])
+
+        return self.schemas[stream_id]
+
+    def open_writer(self, path, schema):
+        if self.export_format == 'parquet':
+            return self.pa.parquet.ParquetWriter(str(path), schema)
+
+        return self.pa.ipc.new_file(str(path), schema)
+
+    def open_batch(self, stream_id, stream_schema, start_date, end_date):
+        """
+        Returns a BatchFile that writes the pages of a single date batch of a
+        stream to one file.
+        """
+        start_date_string = start_date.strftime("%Y-%m-%d")
+        end_date_string = end_date.strftime("%Y-%m-%d")
+
+        partition = Path(self.export_path, stream_id, f'report_start_date={start_date_string}')
+        path = partition.joinpath(f'{start_date_string}_{end_date_string}{self.extension}')
+
+        return BatchFile(self, stream_id, self.arrow_schema(stream_id, stream_schema), path, start_date_string, end_date_string)
+
+    def write_manifest(self):
+        singer.write_message(ManifestMessage(self.export_format, self.export_path, self.manifest))
+
+
+class BatchFile:
+    """
+    A single export file. It is written under a temporary name and renamed
+    once closed, so a failed batch never leaves a partial file behind.
+    """
+    def __init__(self, exporter, stream_id, schema, path, start_date_string, end_date_string):
+        self.exporter = exporter
+        self.stream_id = stream_id
+        self.schema = schema
+        self.path = path
+        # Unique, so that processes running the same batch don't write to the same file
+        self.tmp_path = path.with_name('{}.{}.tmp'.format(path.name, uuid.uuid4().hex))
+        self.start_date_string = start_date_string
+        self.end_date_string = end_date_string
+        self.writer = None
+        self.row_count = 0
+
+    def write(self, records):
+        # Every page is written as its own row group
+        if not records:
+            return
+
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = self.exporter.open_writer(self.tmp_path, self.schema)
+
+        columns = {name: [record.get(name) for record in records] for name in self.schema.names}
+        self.writer.write_table(self.exporter.pa.Table.from_pydict(columns, schema=self.schema))
+        self.row_count += len(records)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.tmp_path.unlink()
+            self.writer = None
+
+    def close(self):
+        """Publishes the file and returns the number of rows written."""
+        if self.writer is None:
+            return 0
+
+        self.writer.close()
+        self.writer = None
+        os.replace(self.tmp_path, self.path)
+        replaced_paths = self.remove_superseded_files()
+
+        self.exporter.manifest.setdefault(self.stream_id, []).append({
+            'path': str(self.path),
+            'report_start_date': self.start_date_string,
+            'report_end_date': self.end_date_string,
+            'rows': self.row_count,
+            'replaces': replaced_paths
+        })
+
+        return self.row_count
+
+    def remove_superseded_files(self):
+        """
+        Removes the files of earlier runs that this batch supersedes: the
+        ones in the same partition that end on or before this batch, e.g. the
+        file of a batch that was cut short by the end_date of an earlier run.
+        """
+        replaced_paths = []
+        for path in self.path.parent.glob('*' + self.exporter.extension):
+            start_date_string, _, end_date_string = path.stem.partition('_')
+            if path != self.path and start_date_string == self.start_date_string and end_date_string <= self.end_date_string:
+                path.unlink()
+                replaced_paths.append(str(path))
+
+        return replaced_paths
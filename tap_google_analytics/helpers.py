@@ -1,6 +1,13 @@
 import json
 import hashlib
 
+# Number of days added to the start of a date batch to get its end, per date_batching value
+DATE_BATCHING_INTERVALS = {
+    'DAY': 0,
+    'WEEK': 6,
+    'MONTH': 29
+}
+
 def load_json(path):
     with open(path) as f:
         return json.load(f)
@@ -0,0 +1,124 @@
+import queue
+import threading
+
+import singer
+
+from .client import ReportStatus
+
+LOGGER = singer.get_logger()
+
+# How often a blocked producer checks whether the pipeline was closed
+PUT_TIMEOUT = 0.1
+
+
+def fetch_date_batches(client, plan, can_start_batch):
+    """
+    Yields (group, batch index, pages, report status) for every planned date
+    batch, as long as `can_start_batch()` allows it. `pages` lazily fetches
+    and decodes the response pages of the batch, and has to be consumed
+    before the next batch is requested.
+    """
+    for group, index in plan:
+        if not can_start_batch():
+            return
+
+        batch_start_date, batch_end_date = group['batches'][index]
+        report_status = ReportStatus()
+        # Once GA rejected the merged query of a group, the caller queries its streams separately
+        if group.get('split_streams'):
+            pages = iter([])
+        else:
+            pages = client.iterate_stream_pages(batch_start_date, batch_end_date, group, group['segment_ids'], report_status)
+
+        yield group, index, pages, report_status
+
+
+class FetchPipeline:
+    """
+    Runs fetch_date_batches() on a background thread, ahead of the thread
+    writing the records out, so that waiting on the API and waiting on the
+    target overlap.
+
+    The fetched pages are handed over through a queue of `queue_size` items.
+    Once it is full, fetching pauses until the writer catches up. Batches and
+    their pages come out in the planned order. An error raised while a batch
+    is fetched is raised again when its pages are consumed, so callers handle
+    errors exactly like with fetch_date_batches() alone.
+    """
+    def __init__(self, date_batches, queue_size):
+        self.date_batches = date_batches
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.produce, name='tap-google-analytics-fetch', daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        # Blocks while the queue is full, unless the pipeline gets closed meanwhile
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce(self):
+        try:
+            for group, index, pages, report_status in self.date_batches:
+                if not self.put(('batch', (group, index, report_status))):
+                    return
+
+                try:
+                    for results in pages:
+                        if not self.put(('page', results)):
+                            return
+                except BaseException as e:
+                    self.put(('error', e))
+                    continue
+
+                if not self.put(('end', None)):
+                    return
+        except BaseException as e:
+            # Errors outside of a batch, e.g. when checking the quota, end the pipeline
+            self.put(('error', e))
+        finally:
+            self.put(('stop', None))
+
+    def iterate_pages(self, batch):
+        while True:
+            kind, value = self.queue.get()
+            if kind == 'page':
+                yield value
+            elif kind == 'end':
+                batch['consumed'] = True
+                return
+            elif kind == 'error':
+                batch['consumed'] = True
+                raise value
+
+    def __iter__(self):
+        batch = None
+        while True:
+            # Skip what's left of the previous batch if it wasn't fully consumed
+            if batch is not None and not batch['consumed']:
+                try:
+                    for _ in self.iterate_pages(batch):
+                        pass
+                except BaseException:
+                    pass
+
+            kind, value = self.queue.get()
+            if kind == 'stop':
+                return
+            if kind == 'error':
+                raise value
+
+            group, index, report_status = value
+            batch = {'consumed': False}
+            yield group, index, self.iterate_pages(batch), report_status
+
+    def close(self):
+        """Stops fetching and waits for the request in flight, if any, to finish."""
+        self.closed.set()
+        self.thread.join()
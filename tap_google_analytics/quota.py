@@ -0,0 +1,115 @@
+import fcntl
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# Default daily request limits of the Analytics Reporting API
+# https://developers.google.com/analytics/devguides/reporting/core/v4/limits-quotas
+PROJECT_DAILY_LIMIT = 50000
+VIEW_DAILY_LIMIT = 10000
+
+# Number of days kept in the ledger file
+LEDGER_RETENTION_DAYS = 7
+
+
+def quota_day():
+    """
+    Returns the current quota day. GA resets the daily quotas at midnight
+    Pacific Time.
+    """
+    try:
+        from zoneinfo import ZoneInfo
+        return datetime.now(ZoneInfo('America/Los_Angeles')).strftime('%Y-%m-%d')
+    except Exception:
+        # No tz database available, fall back to Pacific Standard Time
+        return datetime.now(timezone(timedelta(hours=-8))).strftime('%Y-%m-%d')
+
+
+def get_project_id(config):
+    """
+    Returns the identifier of the Google Cloud project the requests are
+    billed to: the `quota_project` config value, the project of the service
+    account, or the project number prefix of the OAuth client ID.
+    """
+    if config.get('quota_project'):
+        return config['quota_project']
+
+    if config.get('client_secrets', {}).get('project_id'):
+        return config['client_secrets']['project_id']
+
+    if config.get('oauth_credentials', {}).get('client_id'):
+        return config['oauth_credentials']['client_id'].split('-')[0]
+
+    return 'default'
+
+
+class QuotaLedger:
+    """
+    Counts the API requests made per project, per view and per day in a small
+    JSON file, so that the usage of the daily quotas is known across runs.
+
+    The file is locked for every update, so concurrent tap processes sharing
+    the same ledger keep an accurate count.
+    """
+    def __init__(self, config):
+        self.path = Path(config['quota_ledger'])
+        self.project_id = get_project_id(config)
+        self.view_id = str(config['view_id'])
+        self.project_limit = config.get('quota_project_daily_limit', PROJECT_DAILY_LIMIT)
+        self.view_limit = config.get('quota_view_daily_limit', VIEW_DAILY_LIMIT)
+        self.reserve = config.get('quota_reserve', 10)
+        self.lock = threading.Lock()
+
+    def update(self, requests=0):
+        """
+        Adds `requests` to today's counts and returns the (project, view)
+        request counts of today.
+        """
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    try:
+                        ledger = json.loads(content) if content else {}
+                    except ValueError:
+                        LOGGER.warning(f"Quota ledger '{self.path}' is corrupted, starting a new one")
+                        ledger = {}
+
+                    day = quota_day()
+                    usage = ledger.setdefault(day, {'projects': {}, 'views': {}})
+                    usage['projects'][self.project_id] = usage['projects'].get(self.project_id, 0) + requests
+                    usage['views'][self.view_id] = usage['views'].get(self.view_id, 0) + requests
+
+                    if requests:
+                        # Only keep the last few days
+                        for old_day in sorted(ledger)[:-LEDGER_RETENTION_DAYS]:
+                            del ledger[old_day]
+
+                        f.seek(0)
+                        f.truncate()
+                        json.dump(ledger, f, indent=2, sort_keys=True)
+                        f.flush()
+
+                    return (usage['projects'][self.project_id], usage['views'][self.view_id])
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def record_request(self):
+        self.update(1)
+
+    def remaining(self):
+        """Returns the number of requests left today for both the project and the view."""
+        (project_requests, view_requests) = self.update()
+        return min(self.project_limit - project_requests, self.view_limit - view_requests)
+
+    def is_exhausted(self):
+        # Keep a few requests in reserve, as a batch can take more than one request
+        return self.remaining() <= self.reserve
@@ -0,0 +1,145 @@
+import copy
+import hashlib
+import json
+import os
+import socketserver
+import sys
+import threading
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# Config keys that only change what is synced, not how the Client is set up
+JOB_ONLY_CONFIG_KEYS = ['start_date', 'end_date', 'reports', 'lookback_days', 'date_batching']
+
+
+class ThreadLocalStdout:
+    """
+    Stands in for sys.stdout, sending what every job thread writes to the
+    socket of its own job. singer.write_message always writes to sys.stdout,
+    so this is what keeps the Singer output of concurrent jobs apart.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def redirect(self, stream):
+        if stream is not None:
+            self.local.stream = stream
+        elif hasattr(self.local, 'stream'):
+            del self.local.stream
+
+    def write(self, data):
+        return getattr(self.local, 'stream', self.stdout).write(data)
+
+    def flush(self):
+        return getattr(self.local, 'stream', self.stdout).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class SyncJobHandler(socketserver.StreamRequestHandler):
+    """
+    Runs a single job sent over the socket.
+
+    The job is a single JSON line:
+      {"config": {...}, "state": {...}, "catalog": {...}, "discover": false}
+
+    The Singer messages of the job (or the catalog in discover mode) are
+    streamed back over the connection, followed by a final line:
+      {"type": "EXIT", "code": 0}
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        stdout = self.wfile_text()
+        with self.server.job_slots:
+            exit_code = self.server.run_job(line, stdout)
+
+        stdout.write(json.dumps({'type': 'EXIT', 'code': exit_code}) + '\n')
+        stdout.flush()
+
+    def wfile_text(self):
+        return open(self.wfile.fileno(), 'w', buffering=1, encoding='utf-8', closefd=False)
+
+
+class SyncServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long running server that keeps Clients, with their credentials, API
+    discovery documents and dimension/metric metadata, warm between sync
+    jobs. Every job thread builds its own service objects from the cached
+    discovery documents, as httplib2 isn't thread safe.
+
+    At most `max_jobs` jobs run at the same time; further connections wait
+    for a free slot.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_jobs):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        super().__init__(socket_path, SyncJobHandler)
+        self.job_slots = threading.BoundedSemaphore(max_jobs)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def get_client(self, config):
+        """
+        Returns the warm Client for the given config, creating it on first use.
+        Configs that only differ in their date range or reports share a Client.
+        """
+        from .client import Client
+
+        client_config = {key: value for key, value in config.items() if key not in JOB_ONLY_CONFIG_KEYS}
+        key = hashlib.sha256(json.dumps(client_config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        with self.clients_lock:
+            if key not in self.clients:
+                LOGGER.info(f"Creating client for view {config.get('view_id')}")
+                self.clients[key] = Client(config)
+
+            return self.clients[key]
+
+    def run_job(self, line, stdout):
+        from . import process_config
+        from .discover import discover
+        from .sync import sync
+
+        sys.stdout.redirect(stdout)
+        try:
+            job = json.loads(line)
+            config = process_config(copy.deepcopy(job['config']))
+            client = self.get_client(config)
+
+            if job.get('discover'):
+                stdout.write(json.dumps(discover(config, client), indent=2) + '\n')
+            else:
+                catalog = job.get('catalog') or discover(config, client)
+                sync(config, job.get('state') or {}, catalog, client)
+
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception:
+            LOGGER.exception('Sync job failed')
+            return 1
+        finally:
+            sys.stdout.redirect(None)
+
+
+def serve(socket_path, max_jobs):
+    sys.stdout = ThreadLocalStdout(sys.stdout)
+
+    with SyncServer(socket_path, max_jobs) as server:
+        LOGGER.info(f'Listening for sync jobs on {socket_path}, running up to {max_jobs} at a time')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
@@ -0,0 +1,82 @@
+import signal
+import threading
+from time import monotonic
+
+import singer
+
+LOGGER = singer.get_logger()
+
+SHUTDOWN_SIGNALS = [signal.SIGINT, signal.SIGTERM]
+
+
+class StateEmitter:
+    """
+    Coalesces STATE messages, so that a sync with many small date batches
+    doesn't make the target flush and commit after every single batch.
+
+    The state is emitted once `every_batches` batches, `every_seconds`
+    seconds or `every_records` records have gone by since the last STATE
+    message, whichever comes first. Without any of them configured, the
+    state is emitted after every batch.
+
+    The state is only ever emitted after the records of the batches it
+    bookmarks were written, so resuming from any emitted state is safe.
+    """
+    def __init__(self, config):
+        self.every_batches = config.get('state_emit_every_batches')
+        self.every_seconds = config.get('state_emit_every_seconds')
+        self.every_records = config.get('state_emit_every_records')
+
+        if not (self.every_batches or self.every_seconds or self.every_records):
+            self.every_batches = 1
+
+        self.pending_batches = 0
+        self.pending_records = 0
+        self.last_emitted = monotonic()
+        self.shutdown_requested = False
+        self.previous_handlers = {}
+
+    def batch_completed(self, state, record_count=0):
+        self.pending_batches += 1
+        self.pending_records += record_count
+
+        if (self.every_batches and self.pending_batches >= self.every_batches) \
+          or (self.every_records and self.pending_records >= self.every_records) \
+          or (self.every_seconds and monotonic() - self.last_emitted >= self.every_seconds):
+            self.emit(state)
+
+    def flush(self, state):
+        # Emits the state if anything changed since the last STATE message
+        if self.pending_batches:
+            self.emit(state)
+
+    def emit(self, state):
+        singer.write_state(state)
+        self.pending_batches = 0
+        self.pending_records = 0
+        self.last_emitted = monotonic()
+
+    def install_signal_handlers(self):
+        """
+        On the first SIGINT or SIGTERM, asks the sync to stop after the
+        current date batch, so that the state is flushed and the run can be
+        resumed. A second signal stops immediately.
+        """
+        def request_shutdown(signum, frame):
+            if self.shutdown_requested:
+                raise KeyboardInterrupt()
+
+            LOGGER.warning(f'Received {signal.Signals(signum).name}, stopping after the current date batch.')
+            self.shutdown_requested = True
+
+        # Signal handlers can only be set from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        for signum in SHUTDOWN_SIGNALS:
+            self.previous_handlers[signum] = signal.signal(signum, request_shutdown)
+
+    def restore_signal_handlers(self):
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers = {}
@@ -1,23 +1,39 @@
 import sys
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
 from timeit import default_timer as timer
 
 import singer
 from singer import utils, metadata, get_bookmark
 
-from .client import Client
+from .client import Client, ReportStatus
 from .discover import Report
+from .export import Exporter
+from .pipeline import fetch_date_batches, FetchPipeline
+from .state import StateEmitter
 from .error import *
 
 LOGGER = singer.get_logger()
 
+# GA accepts at most 10 metrics in a single query
+MAX_METRICS_PER_QUERY = 10
+
+# Settings of a stream, possibly overridden by its report definition, that its query group has to share
+GROUP_SETTINGS = ['date_batching', 'fixed_date_batching', 'sampling_level', 'segment_ids', 'segment_concurrency', 'priority']
+
+# Errors that are worth retrying at the end of the run, once the backoff in the client ran out
+RETRYABLE_ERRORS = (GaRateLimitError, GaQuotaExceededError, GaBackendServerError)
+
+# Export batches are aligned on a grid of date_batching intervals counted from this date
+EXPORT_GRID_START_DATE = datetime(2005, 1, 1, tzinfo=timezone.utc)
+
 def generate_report_dates(start_date, end_date):
     total_days = (end_date - start_date).days
     # NB: Add a day to be inclusive of both start and end
     for day_offset in range(total_days + 1):
         yield start_date + timedelta(days=day_offset)
 
-def batch_report_dates(start_date, end_date, interval):
+def batch_report_dates(start_date, end_date, interval, fixed_interval=False):
     """
     Generate tuples with intervals from a given range of dates.
 
@@ -25,11 +41,14 @@ def batch_report_dates(start_date, end_date, interval):
 
     1st yield = ('2018-01-01', '2018-01-07')
     2nd yield = ('2018-01-08', '2018-01-14')
+
+    Ranges under 30 days are batched daily, unless the interval is fixed,
+    i.e. set by the report definition of the stream.
     """
     date_diff = (end_date - start_date).days
 
     # If the date range is smaller than 30 days, opt for daily batching.
-    if date_diff < 30:
+    if date_diff < 30 and not fixed_interval:
         interval = 0
 
     span = timedelta(days=interval)
@@ -42,6 +61,46 @@ def batch_report_dates(start_date, end_date, interval):
 
     yield start_date, end_date
 
+def align_report_dates(start_date, end_date, interval, min_date, max_date):
+    """
+    Generate the date batches covering start_date to end_date on a fixed grid
+    of `interval` + 1 days, clipped to min_date and max_date.
+
+    Unlike batch_report_dates, a date always falls in the same batch, no
+    matter which range it is synced with.
+    """
+    span = timedelta(days=interval + 1)
+    batch_start_date = EXPORT_GRID_START_DATE + span * ((start_date - EXPORT_GRID_START_DATE) // span)
+
+    while batch_start_date <= end_date:
+        batch_end_date = batch_start_date + span - timedelta(days=1)
+        yield max(batch_start_date, min_date), min(batch_end_date, max_date)
+        batch_start_date = batch_end_date + timedelta(days=1)
+
+def get_date_batches(config, sync_ranges, interval, fixed_interval=False):
+    """
+    Returns the date batches to sync the given date ranges with.
+
+    In export mode every date batch is written to a file named after its
+    dates, so the batches are aligned on a fixed grid instead: a date that is
+    synced again, e.g. in the lookback window, is then fetched with the same
+    batch as before and overwrites its earlier file, rather than ending up in
+    a second file.
+    """
+    if not config.get('export_format'):
+        return [
+            batch
+            for range_start_date, range_end_date in sync_ranges
+            for batch in batch_report_dates(range_start_date, range_end_date, interval, fixed_interval)
+        ]
+
+    # Adjacent ranges can share a batch of the grid
+    return list(dict.fromkeys(
+        batch
+        for range_start_date, range_end_date in sync_ranges
+        for batch in align_report_dates(range_start_date, range_end_date, interval, config['start_date'], config['end_date'])
+    ))
+
 
 def get_selected_streams(catalog):
     '''
@@ -59,81 +118,547 @@ def get_selected_streams(catalog):
 
     return selected_streams
 
-def sync(config, state, catalog):
+def get_query_groups(streams, merge_streams=True):
+    """
+    Groups the streams that share exactly the same dimensions, filters,
+    settings and date ranges to sync, so that they can be fetched with a
+    single query per date batch.
+
+    The metrics of the grouped streams are merged up to GA's limit of 10
+    metrics per query, and the columns are split back per stream once the
+    records are fetched.
+    """
+    groups = []
+
+    for stream in streams:
+        report_definition = stream['report_definition']
+
+        for group in groups if merge_streams else []:
+            merged_metrics = group['metrics'] + [metric for metric in report_definition['metrics'] if metric not in group['metrics']]
+
+            if group['dimensions'] == report_definition['dimensions'] \
+              and group['filters'] == report_definition['filters'] \
+              and group['sync_ranges'] == stream['sync_ranges'] \
+              and all(group[key] == stream['settings'][key] for key in GROUP_SETTINGS) \
+              and len(merged_metrics) <= MAX_METRICS_PER_QUERY:
+                group['metrics'] = merged_metrics
+                group['streams'].append(stream)
+                break
+        else:
+            groups.append({
+                'dimensions': list(report_definition['dimensions']),
+                'metrics': list(report_definition['metrics']),
+                'filters': report_definition['filters'],
+                'sync_ranges': stream['sync_ranges'],
+                'streams': [stream],
+                **stream['settings']
+            })
+
+    return groups
+
+def split_query_group(group):
+    # Returns a query group for every stream of a merged group, to query them separately
+    return [
+        dict(group, metrics=list(stream['report_definition']['metrics']), streams=[stream])
+        for stream in group['streams']
+    ]
+
+def split_records(records, stream, group):
+    """
+    Returns the records of a merged query with only the columns of the given stream.
+
+    GA leaves out the rows where all the requested metrics are zero, so the
+    rows where all of this stream's metrics are zero are dropped to return
+    exactly the rows the stream would have got on its own.
+    """
+    if len(group['streams']) == 1:
+        return records
+
+    properties = stream['schema']['properties']
+    metrics = stream['report_definition']['metrics']
+
+    return [
+        {key: value for key, value in record.items() if key in properties}
+        for record in records
+        if not all(record.get(metric) == 0 for metric in metrics)
+    ]
+
+def can_sync_stream(stream_id, report_definition, stream_config):
+    """
+    Returns False, once the reason is logged, if a selected stream can't be
+    synced as its catalog entry and config stand.
+    """
+    # GA reports need at least one metric
+    if not report_definition['metrics']:
+        LOGGER.error("Skipping stream: '{}' as all of its metrics are deselected.".format(stream_id))
+        return False
+
+    # Rows of different segments can only be told apart by the ga:segment dimension
+    if len(stream_config.get('segment_ids', [])) > 1 and 'ga_segment' not in report_definition['dimensions']:
+        LOGGER.error("Skipping stream: '{}' as it has no ga:segment dimension to split multiple segments.".format(stream_id))
+        return False
+
+    return True
+
+def sync_date_batch(client, exporter, group, start_date, end_date, segment_ids, report_status=None):
+    """
+    Fetches a single date batch of a query group, writes the records of
+    each stream in the group and returns the number of records written.
+    """
+    pages = client.iterate_stream_pages(start_date, end_date, group, segment_ids, report_status)
+
+    return write_date_batch(exporter, group, start_date, end_date, pages)
+
+def write_date_batch(exporter, group, start_date, end_date, pages):
+    """
+    Writes the records of each stream in a query group from the fetched
+    pages of a date batch and returns the number of records written.
+
+    Every page is written as soon as it is fetched, so that only one page
+    is held in memory at a time. If the batch fails halfway, the records
+    already written are written again when it's retried, which targets
+    dedupe with the `_sdc_record_hash` key.
+    """
+    streams = group['streams']
+    record_count = 0
+
+    if exporter is None:
+        for results in pages:
+            for stream in streams:
+                records = split_records(results, stream, group)
+                singer.write_records(stream['tap_stream_id'], records)
+                record_count += len(records)
+        return record_count
+
+    batches = [exporter.open_batch(stream['tap_stream_id'], stream['schema'], start_date, end_date) for stream in streams]
+    try:
+        for results in pages:
+            for stream, batch in zip(streams, batches):
+                batch.write(split_records(results, stream, group))
+    except BaseException:
+        for batch in batches:
+            batch.abort()
+        raise
+
+    for batch in batches:
+        record_count += batch.close()
+
+    return record_count
+
+def plan_date_batches(groups, priority='catalog'):
+    """
+    Returns the (query group, batch index) pairs in the order they are synced.
+
+    With the `catalog` priority, the streams are synced one after the other,
+    oldest batch first. With `most_recent_first`, the newest batches of all
+    the streams are synced first, so that running out of quota only delays
+    the oldest data. Either way, streams with a higher `priority` in their
+    report definition go first.
+    """
+    # The sorts are stable, so streams with the same priority keep the catalog order
+    groups = sorted(groups, key=lambda group: group['priority'], reverse=True)
+    plan = [(group, index) for group in groups for index in range(len(group['batches']))]
+
+    if priority == 'most_recent_first':
+        plan.sort(key=lambda item: (item[0]['batches'][item[1]][1], item[0]['priority']), reverse=True)
+
+    return plan
+
+def merge_ranges(date_ranges):
+    """
+    Merges overlapping and adjacent (start_date, end_date) ranges, both ends
+    inclusive, into a sorted list of disjoint ranges.
+    """
+    merged = []
+    for start_date, end_date in sorted(date_ranges):
+        if merged and start_date <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end_date))
+        else:
+            merged.append((start_date, end_date))
+
+    return merged
+
+def subtract_range(date_ranges, start_date, end_date):
+    # Returns the parts of the given ranges that are outside start_date to end_date
+    remaining = []
+    for range_start_date, range_end_date in date_ranges:
+        if range_end_date < start_date or range_start_date > end_date:
+            remaining.append((range_start_date, range_end_date))
+            continue
+
+        if range_start_date < start_date:
+            remaining.append((range_start_date, start_date - timedelta(days=1)))
+        if range_end_date > end_date:
+            remaining.append((end_date + timedelta(days=1), range_end_date))
+
+    return remaining
+
+def load_completed_ranges(state, stream_id, start_date):
+    """
+    Returns the date ranges of a stream that were synced, from its
+    `completed_ranges` bookmark.
+
+    States written before completed ranges existed only have a
+    `last_report_date` bookmark, plus the `failed_batches` of previous runs.
+    For those, everything from the start date to `last_report_date` counts
+    as completed, except the failed batches, which become gaps.
+    """
+    completed_ranges = get_bookmark(state, stream_id, 'completed_ranges')
+    if completed_ranges is not None:
+        return merge_ranges([
+            (utils.strptime_to_utc(range_start_date), utils.strptime_to_utc(range_end_date))
+            for range_start_date, range_end_date in completed_ranges
+        ])
+
+    last_report_date = get_bookmark(state, stream_id, 'last_report_date')
+    if last_report_date is None:
+        return []
+
+    last_report_date = utils.strptime_to_utc(last_report_date)
+    completed_ranges = [(min(start_date, last_report_date), last_report_date)]
+    for failed_start_date, failed_end_date in get_bookmark(state, stream_id, 'failed_batches', []):
+        completed_ranges = subtract_range(completed_ranges, utils.strptime_to_utc(failed_start_date), utils.strptime_to_utc(failed_end_date))
+
+    return completed_ranges
+
+def write_completed_ranges(state, stream_id, completed_ranges, start_date):
+    """
+    Writes the completed ranges of a stream to its bookmarks.
+
+    `last_report_date` is kept up to date for tools that read it, as the end
+    of the first completed range. It is only written once that range starts
+    at `start_date`, so that all the dates from `start_date` up to it are
+    synced. While there is a gap at the start, it is left as it was.
+    """
+    completed_ranges = merge_ranges(completed_ranges)
+    singer.write_bookmark(state, stream_id, 'completed_ranges', [
+        [range_start_date.strftime("%Y-%m-%d"), range_end_date.strftime("%Y-%m-%d")]
+        for range_start_date, range_end_date in completed_ranges
+    ])
+    if completed_ranges and completed_ranges[0][0] <= start_date:
+        singer.write_bookmark(state, stream_id, 'last_report_date', completed_ranges[0][1].strftime("%Y-%m-%d"))
+
+    # Failed batches are gaps in the completed ranges now
+    state['bookmarks'][stream_id].pop('failed_batches', None)
+
+def add_completed_range(state, stream_ids, start_date, end_date, sync_start_date):
+    # Records a date batch that was synced in the bookmarks of streams synced from sync_start_date
+    for stream_id in stream_ids:
+        completed_ranges = load_completed_ranges(state, stream_id, sync_start_date)
+        write_completed_ranges(state, stream_id, completed_ranges + [(start_date, end_date)], sync_start_date)
+
+def update_golden_date(state, stream_ids, end_date):
+    # Records the end of a date batch that GA reported as golden, i.e. final
+    last_golden_date = end_date.strftime("%Y-%m-%d")
+    for stream_id in stream_ids:
+        if get_bookmark(state, stream_id, 'last_golden_date', '') < last_golden_date:
+            singer.write_bookmark(state, stream_id, 'last_golden_date', last_golden_date)
+
+def is_range_completed(state, stream_ids, start_date, end_date):
+    # Whether a date range is completed for all the given streams
+    for stream_id in stream_ids:
+        missing_ranges = [(start_date, end_date)]
+        for range_start_date, range_end_date in load_completed_ranges(state, stream_id, start_date):
+            missing_ranges = subtract_range(missing_ranges, range_start_date, range_end_date)
+
+        if missing_ranges:
+            return False
+
+    return True
+
+def get_sync_ranges(config, state, stream_id):
+    """
+    Returns the date ranges of a stream that have to be synced: the dates
+    from `start_date` to `end_date` that aren't completed yet, plus the
+    last `lookback_days` of the completed dates, as recent data may still
+    change. The lookback starts after the last date that came back golden,
+    as GA guarantees golden data won't change any more.
+
+    Legacy bookmarks of the stream are converted to completed ranges.
+    """
+    completed_ranges = load_completed_ranges(state, stream_id, config['start_date'])
+    if get_bookmark(state, stream_id, 'completed_ranges') is None and get_bookmark(state, stream_id, 'last_report_date') is not None:
+        write_completed_ranges(state, stream_id, completed_ranges, config['start_date'])
+
+    if completed_ranges:
+        last_completed_date = completed_ranges[-1][1]
+        lookback_start_date = last_completed_date - timedelta(days=config.get('lookback_days', 15))
+
+        last_golden_date = get_bookmark(state, stream_id, 'last_golden_date')
+        if last_golden_date is not None:
+            lookback_start_date = max(lookback_start_date, utils.strptime_to_utc(last_golden_date) + timedelta(days=1))
+
+        completed_ranges = subtract_range(completed_ranges, lookback_start_date, last_completed_date)
+
+    sync_ranges = [(config['start_date'], config['end_date'])]
+    for range_start_date, range_end_date in completed_ranges:
+        sync_ranges = subtract_range(sync_ranges, range_start_date, range_end_date)
+
+    return sync_ranges
+
+def retry_deferred_batches(client, exporter, state, state_emitter, deferred_batches, attempts, delay, max_failures, can_start_batch, sync_start_date):
+    """
+    Retries the date batches that failed with rate limit, quota or backend
+    errors, each with up to `attempts` tries and an exponential delay between
+    them. Batches that succeed are added to the completed ranges in state;
+    the rest are left as gaps, to be fetched in the next run.
+
+    Once `max_failures` batches in a row gave up, GA is most likely still
+    unavailable, so the remaining batches are left for the next run too
+    rather than spending the full delays on each of them.
+
+    Like in the main loop, every attempt first checks `can_start_batch()`,
+    and the retries stop once it refuses, e.g. when the daily quota is
+    nearly exhausted.
+
+    Returns True if any batch still failed.
+    """
+    still_failing = False
+    consecutive_failures = 0
+
+    for index, (group, start_date, end_date) in enumerate(deferred_batches):
+        if consecutive_failures >= max_failures:
+            still_failing = True
+            LOGGER.error(f'Stopping the retries after {consecutive_failures} date batches in a row failed, the {len(deferred_batches) - index} remaining batches are left as gaps in the state to be fetched in the next run.')
+            break
+
+        stream_ids = [stream['tap_stream_id'] for stream in group['streams']]
+        stream_names = ', '.join(stream_ids)
+
+        # The batch may have been fetched since, e.g. by another query group
+        if is_range_completed(state, stream_ids, start_date, end_date):
+            continue
+
+        singer.set_currently_syncing(state, stream_ids[0])
+
+        for attempt in range(1, attempts + 1):
+            if not can_start_batch():
+                return still_failing
+
+            LOGGER.info(f'Retrying {stream_names} for {start_date.isoformat()} to {end_date.isoformat()} (attempt {attempt} of {attempts}).')
+            try:
+                report_status = ReportStatus()
+                record_count = sync_date_batch(client, exporter, group, start_date, end_date, group['segment_ids'], report_status)
+
+                add_completed_range(state, stream_ids, start_date, end_date, sync_start_date)
+                if report_status.is_data_golden:
+                    update_golden_date(state, stream_ids, end_date)
+                state_emitter.batch_completed(state, record_count)
+                consecutive_failures = 0
+                break
+            except GaInvalidArgumentError as e:
+                still_failing = True
+                LOGGER.error("Retry of '{}' failed due to invalid report definition.".format(stream_names))
+                LOGGER.debug("Error: '{}'.".format(e))
+                break
+            except RETRYABLE_ERRORS as e:
+                LOGGER.warning("Retry of '{}' failed due to {}.".format(stream_names, type(e).__name__))
+                LOGGER.debug("Error: '{}'.".format(e))
+                if attempt < attempts:
+                    time.sleep(delay * 2 ** (attempt - 1))
+        else:
+            still_failing = True
+            consecutive_failures += 1
+            LOGGER.error(f'Giving up on {stream_names} for {start_date.isoformat()} to {end_date.isoformat()}, it is left as a gap in the state to be fetched in the next run.')
+
+    return still_failing
+
+def sync(config, state, catalog, client=None):
     errors_encountered = False
 
     selected_stream_ids = get_selected_streams(catalog)
 
-    client = Client(config)
+    # A client can be passed in to reuse its credentials and metadata, e.g. by the sync server
+    owns_client = client is None
+    if owns_client:
+        client = Client(config)
+
+    # In export mode the records are written to files and only STATE messages
+    # (plus a final MANIFEST) are emitted on stdout
+    exporter = Exporter(config) if config.get('export_format') else None
 
     # Check if there are existing bookmarks, if not create a new one
     state['bookmarks'] = state.get('bookmarks', {})
 
-    # Loop over streams in catalog
+    streams = []
+    # Date batches that failed with retryable errors, retried once all the streams are synced
+    deferred_batches = []
+
     for stream in catalog['streams']:
         stream_id = stream['tap_stream_id']
-        stream_schema = stream['schema']
+
+        if stream_id not in selected_stream_ids:
+            LOGGER.info('Skipping unselected stream: ' + stream_id)
+            continue
+
         report_definition = Report.get_report_definition(stream)
+        stream_config = Report.get_stream_config(config, stream)
+        segment_ids = stream_config.get('segment_ids', [])
+
+        if not can_sync_stream(stream_id, report_definition, stream_config):
+            errors_encountered = True
+            continue
 
         stream_metadata = metadata.to_map(stream['metadata'])
-        key_properties = metadata.get(stream_metadata, (), "table-key-properties")
-
-        if stream_id in selected_stream_ids:
-            start_date = utils.strptime_to_utc(get_bookmark(state, stream_id, 'last_report_date', default=config['start_date'].strftime('%Y-%m-%d')))
-            start_date = start_date - timedelta(days=config.get('lookback_days', 15))
-            end_date = config['end_date']
-            date_interval = config['date_batching']
-            segment_id = config.get('segment_id', None)
-
-            LOGGER.info(f'Syncing stream: {stream_id}')
-            LOGGER.info(f'Will sync data from {start_date.isoformat()} until {end_date.isoformat()}')
-
-            # Sets the currently sycing stream in state
-            singer.set_currently_syncing(state, stream_id)
-            # Writes the schema for the current stream
-            singer.write_schema(stream_id, stream_schema, key_properties)
-
-            for start_date, end_date in batch_report_dates(start_date, end_date, date_interval):
-                LOGGER.info(f'Request for {start_date.isoformat()} to {end_date.isoformat()} started.')
-                start = timer()
+
+        streams.append({
+            'tap_stream_id': stream_id,
+            'schema': Report.get_selected_schema(stream),
+            'key_properties': metadata.get(stream_metadata, (), "table-key-properties"),
+            'report_definition': report_definition,
+            'sync_ranges': get_sync_ranges(stream_config, state, stream_id),
+            'settings': {
+                'date_batching': stream_config['date_batching'],
+                'fixed_date_batching': 'date_batching' in Report.get_overrides(stream),
+                'sampling_level': stream_config.get('sampling_level'),
+                'segment_ids': segment_ids,
+                'segment_concurrency': stream_config.get('segment_concurrency'),
+                'priority': stream_config.get('priority', 0)
+            }
+        })
+
+    groups = get_query_groups(streams, config.get('merge_streams', True))
+
+    for group in groups:
+        group['batches'] = get_date_batches(config, group['sync_ranges'], group['date_batching'], group['fixed_date_batching'])
+        group['remaining_batches'] = len(group['batches'])
+
+        # Writes the schema for the current streams
+        if exporter is None:
+            for stream in group['streams']:
+                singer.write_schema(stream['tap_stream_id'], stream['schema'], stream['key_properties'])
+
+    quota_ledger = client.quota_ledger
+    quota_exhausted = False
+    current_group = None
+
+    state_emitter = StateEmitter(config)
+    state_emitter.install_signal_handlers()
+
+    def can_start_batch():
+        nonlocal quota_exhausted
+
+        if state_emitter.shutdown_requested:
+            return False
+
+        # Stop while there is still some quota left, rather than failing halfway through a batch
+        if quota_ledger is not None and quota_ledger.is_exhausted():
+            quota_exhausted = True
+            LOGGER.warning('Stopping the sync as the daily request quota is nearly exhausted. The remaining date batches will be synced in the next run.')
+            return False
+
+        return True
+
+    date_batches = fetch_date_batches(client, plan_date_batches(groups, config.get('quota_priority', 'catalog')), can_start_batch)
+
+    # With a pipeline, the next pages are fetched while the current ones are written out
+    pipeline = None
+    if config.get('pipeline_queue_size'):
+        pipeline = date_batches = FetchPipeline(date_batches, config['pipeline_queue_size'])
+
+    try:
+        # Loop over the date batches of the queries needed to sync the selected streams
+        for group, index, pages, report_status in date_batches:
+            stream_ids = [stream['tap_stream_id'] for stream in group['streams']]
+            stream_names = ', '.join(stream_ids)
+            batch_start_date, batch_end_date = group['batches'][index]
+
+            if state_emitter.shutdown_requested:
+                break
+
+            if group is not current_group:
+                # With the most_recent_first priority, the batches of the groups are interleaved
+                if not group.get('started'):
+                    group['started'] = True
+                    LOGGER.info(f'Syncing streams: {stream_names}' if len(stream_ids) > 1 else f'Syncing stream: {stream_names}')
+                    for range_start_date, range_end_date in group['sync_ranges']:
+                        LOGGER.info(f'Will sync data from {range_start_date.isoformat()} until {range_end_date.isoformat()}')
+
+                current_group = group
+
+                # Sets the currently sycing stream in state
+                singer.set_currently_syncing(state, stream_ids[0])
+
+            LOGGER.info(f'Request for {batch_start_date.isoformat()} to {batch_end_date.isoformat()} started.')
+            start = timer()
+
+            # Once GA rejected the merged query of a group, its streams are queried separately
+            batch_groups = split_query_group(group) if group.get('split_streams') else [group]
+            while batch_groups:
+                batch_group = batch_groups.pop(0)
+                batch_stream_ids = [stream['tap_stream_id'] for stream in batch_group['streams']]
+                batch_stream_names = ', '.join(batch_stream_ids)
                 try:
-                    results = client.process_stream(start_date, end_date, report_definition, segment_id)
+                    if batch_group is group:
+                        record_count = write_date_batch(exporter, group, batch_start_date, batch_end_date, pages)
+                    else:
+                        report_status = ReportStatus()
+                        record_count = sync_date_batch(client, exporter, batch_group, batch_start_date, batch_end_date, batch_group['segment_ids'], report_status)
 
-                    # Writes individual items from results array as records
-                    singer.write_records(stream_id, results)
-                    # Updates the stream bookmark with the latest report timestamp
-                    singer.write_bookmark(state, stream_id, 'last_report_date', end_date.strftime("%Y-%m-%d"))
-                    singer.write_state(state)
+                    # Updates the stream bookmarks with the synced date range
+                    add_completed_range(state, batch_stream_ids, batch_start_date, batch_end_date, config['start_date'])
+                    if report_status.is_data_golden:
+                        update_golden_date(state, batch_stream_ids, batch_end_date)
+                    state_emitter.batch_completed(state, record_count)
                 except GaInvalidArgumentError as e:
+                    if len(batch_group['streams']) > 1:
+                        # Metrics that are valid on their own can still be an invalid combination
+                        LOGGER.warning("Merged query of '{}' was rejected, querying the streams separately.".format(batch_stream_names))
+                        LOGGER.debug("Error: '{}'.".format(e))
+                        group['split_streams'] = True
+                        batch_groups.extend(split_query_group(batch_group))
+                        continue
+
                     errors_encountered = True
-                    LOGGER.error("Skipping stream: '{}' due to invalid report definition.".format(stream_id))
+                    LOGGER.error("Skipping stream: '{}' due to invalid report definition.".format(batch_stream_names))
                     LOGGER.debug("Error: '{}'.".format(e))
-                except GaRateLimitError as e:
-                    errors_encountered = True
-                    LOGGER.error("Skipping stream: '{}' due to Rate Limit Errors.".format(stream_id))
-                    LOGGER.debug("Error: '{}'.".format(e))
-                except GaQuotaExceededError as e:
-                    errors_encountered = True
-                    LOGGER.error("Skipping stream: '{}' due to Quota Exceeded Errors.".format(stream_id))
+                except RETRYABLE_ERRORS as e:
+                    # The batch stays a gap in the completed ranges until it is fetched
+                    LOGGER.warning("Deferring batch of '{}' due to {}.".format(batch_stream_names, type(e).__name__))
                     LOGGER.debug("Error: '{}'.".format(e))
+                    deferred_batches.append((batch_group, batch_start_date, batch_end_date))
                 except GaAuthenticationError as e:
-                    LOGGER.error("Stopping execution while processing '{}' due to Authentication Errors.".format(stream_id))
+                    LOGGER.error("Stopping execution while processing '{}' due to Authentication Errors.".format(batch_stream_names))
                     LOGGER.debug("Error: '{}'.".format(e))
+                    state_emitter.flush(state)
                     sys.exit(1)
                 except GaUnknownError as e:
-                    LOGGER.error("Stopping execution while processing '{}' due to Unknown Errors.".format(stream_id))
+                    LOGGER.error("Stopping execution while processing '{}' due to Unknown Errors.".format(batch_stream_names))
                     LOGGER.debug("Error: '{}'.".format(e))
+                    state_emitter.flush(state)
                     sys.exit(1)
-                end = timer()
-                LOGGER.info(f'Request for {start_date.isoformat()} to {end_date.isoformat()} finished in {(end-start):.2f}.')
+            end = timer()
+            LOGGER.info(f'Request for {batch_start_date.isoformat()} to {batch_end_date.isoformat()} finished in {(end-start):.2f}.')
 
-            singer.set_currently_syncing(state, '')
-            singer.write_state(state)
-        else:
-            LOGGER.info('Skipping unselected stream: ' + stream_id)
+            group['remaining_batches'] -= 1
+            if not group['remaining_batches']:
+                # Always emit the state at the end of a stream
+                state_emitter.flush(state)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+
+    # Skipped batches are left as gaps in the completed ranges, to be fetched in the next run
+    if deferred_batches and not (quota_exhausted or state_emitter.shutdown_requested):
+        LOGGER.info(f'Retrying {len(deferred_batches)} deferred date batches.')
+        if retry_deferred_batches(client, exporter, state, state_emitter, deferred_batches,
+                                  config.get('deferred_retry_attempts', 3), config.get('deferred_retry_delay', 30),
+                                  config.get('deferred_retry_max_failures', 3), can_start_batch, config['start_date']):
+            errors_encountered = True
+
+    state_emitter.restore_signal_handlers()
+
+    singer.set_currently_syncing(state, '')
+    state_emitter.emit(state)
+
+    if owns_client:
+        client.close()
+
+    if exporter is not None:
+        exporter.write_manifest()
 
-    # If we encountered errors, exit with 1
-    if errors_encountered:
+    # If we encountered errors or were asked to stop early, exit with 1
+    if errors_encountered or state_emitter.shutdown_requested:
         sys.exit(1)
 
-    return
\ No newline at end of file
+    return
@@ -0,0 +1,97 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import singer
+
+LOGGER = singer.get_logger()
+
+
+def credentials_identity(config):
+    """
+    Returns a key identifying the credentials in config. It is a hash, so
+    that neither refresh tokens nor client secrets end up in the cache file.
+    """
+    if 'oauth_credentials' in config:
+        identity = [config['oauth_credentials']['client_id'], config['oauth_credentials']['refresh_token']]
+    else:
+        identity = [config.get('client_secrets', {}).get('client_email', config.get('key_file_location'))]
+
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+
+def refresh_credentials(credentials):
+    import google_auth_httplib2
+    import httplib2
+
+    credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+
+
+class TokenCache:
+    """
+    On-disk cache of access tokens, shared by all the tap processes on a node.
+
+    The cache file is locked while a token is looked up and refreshed, so when
+    many processes start at once only the first one hits the token endpoint
+    and the others reuse its token. Tokens are refreshed `refresh_margin`
+    seconds before they expire.
+    """
+    def __init__(self, config):
+        self.path = Path(config['token_cache'])
+        self.key = credentials_identity(config)
+        self.refresh_margin = timedelta(seconds=config.get('token_refresh_margin', 300))
+        self.lock = threading.Lock()
+
+    def needs_refresh(self, expiry):
+        # google-auth expiry dates are naive UTC datetimes
+        return expiry is None or expiry - self.refresh_margin <= datetime.utcnow()
+
+    def ensure_token(self, credentials):
+        """
+        Makes sure the credentials carry an access token that is valid for at
+        least `refresh_margin` seconds, from the cache if possible.
+        """
+        if credentials.token is not None and not self.needs_refresh(credentials.expiry):
+            return
+
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with open(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    content = f.read()
+                    try:
+                        cache = json.loads(content) if content else {}
+                    except ValueError:
+                        cache = {}
+
+                    entry = cache.get(self.key)
+                    expiry = datetime.strptime(entry['expiry'], '%Y-%m-%dT%H:%M:%S') if entry else None
+
+                    if entry and not self.needs_refresh(expiry):
+                        credentials.token = entry['token']
+                        credentials.expiry = expiry
+                        return
+
+                    LOGGER.info('Refreshing the access token')
+                    refresh_credentials(credentials)
+                    cache[self.key] = {
+                        'token': credentials.token,
+                        'expiry': credentials.expiry.strftime('%Y-%m-%dT%H:%M:%S')
+                    }
+
+                    # Drop the tokens of other credentials that have expired
+                    now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+                    cache = {key: value for key, value in cache.items() if value['expiry'] > now}
+
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(cache, f)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
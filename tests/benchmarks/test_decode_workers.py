@@ -0,0 +1,48 @@
+"""
+Decoding throughput of a large response page for a range of decode_workers
+counts. Run with `pytest tests/benchmarks --run-benchmarks -s` to see the
+timings table.
+"""
+from timeit import default_timer as timer
+
+import pytest
+
+from tap_google_analytics.client import Client
+
+from conftest import utc_date
+from test_decode import make_response, without_timestamps
+
+ROW_COUNT = 200000
+
+WORKER_COUNTS = [0, 2, 4, 8]
+
+
+@pytest.mark.benchmark
+def test_decode_workers_scaling(reporting_api, base_config):
+    date = utc_date('2020-01-01')
+    timings = {}
+    baseline = None
+
+    for decode_workers in WORKER_COUNTS:
+        client = Client(dict(base_config, decode_workers=decode_workers, decode_chunk_size=10000))
+        try:
+            # Warm the pool up, so that spawning the workers isn't part of the timing
+            client.process_response(date, date, make_response(20000))
+
+            response = make_response(ROW_COUNT)
+            start = timer()
+            _, records = client.process_response(date, date, response)
+            timings[decode_workers] = timer() - start
+        finally:
+            client.close()
+
+        records = without_timestamps(records)
+        if baseline is None:
+            baseline = records
+        assert records == baseline
+
+    print()
+    print('decode_workers  seconds  rows/s    speedup')
+    for decode_workers, seconds in timings.items():
+        print('{:>14}  {:>7.2f}  {:>8.0f}  {:>6.2f}x'.format(
+            decode_workers, seconds, ROW_COUNT / seconds, timings[WORKER_COUNTS[0]] / seconds))
@@ -0,0 +1,121 @@
+"""
+Peak memory and time to the first record of a large response page, parsed
+once fully downloaded (like googleapiclient does) versus streamed with
+`stream_responses`, fetching the page alone and through a whole sync().
+Run with `pytest tests/benchmarks -k streaming --run-benchmarks -s` to see
+the results tables.
+"""
+import contextlib
+import os
+import tracemalloc
+from timeit import default_timer as timer
+
+import pytest
+
+import tap_google_analytics.client
+from tap_google_analytics.client import Client
+
+from tap_google_analytics.sync import sync
+
+from conftest import FakeCredentials, utc_date
+from test_streaming import STREAM, make_response_body
+
+ROW_COUNT = 100000
+
+
+def buffered_query_api(client, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
+    # Downloads and parses the whole page before returning it, like googleapiclient
+    response = client.get_http_session().post(
+        tap_google_analytics.client.BATCH_GET_URI,
+        json=client.build_request_body(start_date, end_date, report_definition, pageToken, segment_ids),
+        headers=client.authorization_headers()
+    )
+
+    return response.json()
+
+
+def fetch_page(client):
+    date = utc_date('2020-01-01')
+    record_count = 0
+    time_to_first_record = None
+
+    start = timer()
+    # The records of a page are dropped once counted, like once they are written out
+    for records in client.iterate_report_pages(date, date, STREAM, None):
+        if time_to_first_record is None:
+            time_to_first_record = timer() - start
+        record_count += len(records)
+
+    return record_count, time_to_first_record, timer() - start
+
+
+def run_sync(config, catalog):
+    start = timer()
+    # The records are written out to nowhere, like to a target reading them as they come
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sync(config, {}, catalog)
+
+    return timer() - start
+
+
+def measure(client):
+    # Timings are taken without tracemalloc, which slows allocations down a lot
+    record_count, time_to_first_record, total_time = fetch_page(client)
+
+    tracemalloc.start()
+    fetch_page(client)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return record_count, peak_memory, time_to_first_record, total_time
+
+
+@pytest.mark.benchmark
+def test_streaming_peak_memory_and_time_to_first_record(reporting_api, report_server, base_config, monkeypatch):
+    monkeypatch.setattr(Client, 'query_api', buffered_query_api)
+    report_server.response_body = make_response_body(ROW_COUNT)
+    results = {}
+
+    for stream_responses in [False, True]:
+        client = Client(dict(base_config, stream_responses=stream_responses))
+        client.credentials = FakeCredentials('fresh-token')
+        results['streamed' if stream_responses else 'buffered'] = measure(client)
+
+    print()
+    print('{:>10}  {:>8}  {:>14}  {:>19}  {:>10}'.format('mode', 'records', 'peak memory MB', 'first record (s)', 'total (s)'))
+    for mode, (record_count, peak_memory, time_to_first_record, total_time) in results.items():
+        print('{:>10}  {:>8}  {:>14.1f}  {:>19.2f}  {:>10.2f}'.format(mode, record_count, peak_memory / 2 ** 20, time_to_first_record, total_time))
+
+    assert results['streamed'][0] == results['buffered'][0] == ROW_COUNT
+    assert results['streamed'][1] < results['buffered'][1]
+    assert results['streamed'][2] < results['buffered'][2]
+
+
+@pytest.mark.benchmark
+def test_streaming_peak_memory_of_a_sync(reporting_api, report_server, make_catalog, base_config, monkeypatch):
+    catalog = make_catalog([{'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions', 'ga:bounceRate']}])
+    monkeypatch.setattr(Client, 'query_api', buffered_query_api)
+    monkeypatch.setattr(Client, 'initialize_credentials', lambda client, config: FakeCredentials('fresh-token'))
+    report_server.response_body = make_response_body(ROW_COUNT)
+    results = {}
+
+    for stream_responses in [False, True]:
+        # A single date batch, fetched with a single request
+        config = dict(base_config, end_date=base_config['start_date'], stream_responses=stream_responses)
+        total_time = run_sync(config, catalog)
+
+        tracemalloc.start()
+        run_sync(config, catalog)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results['streamed' if stream_responses else 'buffered'] = (peak_memory, total_time)
+
+    print()
+    print('{:>10}  {:>14}  {:>10}'.format('mode', 'peak memory MB', 'total (s)'))
+    for mode, (peak_memory, total_time) in results.items():
+        print('{:>10}  {:>14.1f}  {:>10.2f}'.format(mode, peak_memory / 2 ** 20, total_time))
+
+    # Every chunk of a streamed page is written before the next one is
+    # decoded, so the sync never holds more than a chunk of records
+    assert results['streamed'][0] < results['buffered'][0] / 4
@@ -0,0 +1,256 @@
+import contextlib
+import gzip
+import http.server
+import io
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tap_google_analytics.client import Client
+from tap_google_analytics.discover import Report
+
+DIMENSION_TYPES = {
+    'ga:date': 'STRING',
+    'ga:source': 'STRING',
+    'ga:medium': 'STRING',
+    'ga:segment': 'STRING'
+}
+
+METRIC_TYPES = {
+    'ga:sessions': 'INTEGER',
+    'ga:users': 'INTEGER',
+    'ga:pageviews': 'INTEGER',
+    'ga:bounceRate': 'PERCENT'
+}
+
+SOURCES = ['google', 'bing', 'direct']
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-benchmarks', action='store_true', default=False,
+                     help='Run the benchmarks in tests/benchmarks')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-benchmarks'):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason='benchmarks only run with --run-benchmarks')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
+def utc_date(date_string):
+    return datetime.strptime(date_string, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+def metric_value(dimension_values, metric):
+    # Deterministic values, with some rows where a metric is zero
+    if METRIC_TYPES[metric] == 'PERCENT':
+        return '0.5'
+    return str((sum(map(ord, ''.join(dimension_values))) + len(metric)) % 3)
+
+
+def deselect_fields(catalog, stream_id, attributes):
+    # Deselects fields of a stream in the catalog, like a user editing it
+    stream = next(stream for stream in catalog['streams'] if stream['tap_stream_id'] == stream_id)
+    for entry in stream['metadata']:
+        if entry['breadcrumb'] in [['properties', attribute] for attribute in attributes]:
+            entry['metadata']['selected'] = False
+
+    return catalog
+
+
+class FakeReportingApi:
+    """
+    Answers the batchGet requests of a Client in place of GA: one row per
+    source for every requested date batch.
+
+    Requests matching one of `errors` raise its exception instead, and the
+    batches ending after `golden_until` aren't golden yet.
+    """
+    def __init__(self):
+        self.requests = []
+        self.errors = []
+        self.golden_until = None
+        self.threads = set()
+
+    def fail(self, exception, predicate=lambda start_date, end_date, metrics: True):
+        self.errors.append((predicate, exception))
+
+    def batch_get(self, start_date, end_date, report_definition, segment_ids=None):
+        dimensions = [dimension['name'] for dimension in report_definition['dimensions']]
+        metrics = [metric['expression'] for metric in report_definition['metrics']]
+        self.requests.append((start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), tuple(metrics)))
+        self.threads.add(threading.current_thread().name)
+
+        for predicate, exception in self.errors:
+            if predicate(start_date, end_date, metrics):
+                raise exception
+
+        # Reports without a ga:date dimension aggregate the whole date batch
+        dates = [start_date.strftime('%Y%m%d')]
+        if 'ga:date' in dimensions:
+            dates = [(start_date + timedelta(days=offset)).strftime('%Y%m%d') for offset in range((end_date - start_date).days + 1)]
+
+        rows = []
+        for date in dates:
+            for source in SOURCES:
+                values = {'ga:date': date, 'ga:source': source, 'ga:medium': 'organic', 'ga:segment': 'all'}
+                dimension_values = [values[dimension] for dimension in dimensions]
+                metric_values = [metric_value(dimension_values, metric) for metric in metrics]
+
+                # GA leaves out the rows where all the metrics are zero
+                if all(value == '0' for value in metric_values):
+                    continue
+
+                rows.append({'dimensions': dimension_values, 'metrics': [{'values': metric_values}]})
+
+        is_data_golden = self.golden_until is None or end_date.strftime('%Y-%m-%d') <= self.golden_until
+
+        return {
+            'reports': [{
+                'columnHeader': {
+                    'dimensions': dimensions,
+                    'metricHeader': {'metricHeaderEntries': [{'name': metric} for metric in metrics]}
+                },
+                'data': {'rows': rows, 'isDataGolden': is_data_golden}
+            }]
+        }
+
+
+@pytest.fixture
+def reporting_api(monkeypatch):
+    """Makes every Client in the test talk to a FakeReportingApi instead of GA."""
+    api = FakeReportingApi()
+
+    def query_api(client, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
+        client.record_request()
+        return api.batch_get(start_date, end_date, report_definition, segment_ids)
+
+    monkeypatch.setattr(Client, 'initialize_credentials', lambda client, config: None)
+    monkeypatch.setattr(Client, 'initialize_analyticsreporting', lambda client: None)
+    monkeypatch.setattr(Client, 'fetch_metadata', lambda client: (DIMENSION_TYPES, METRIC_TYPES))
+    monkeypatch.setattr(Client, 'query_api', query_api)
+
+    return api
+
+
+@pytest.fixture
+def base_config():
+    return {
+        'view_id': '1',
+        'start_date': utc_date('2020-01-01'),
+        'end_date': utc_date('2020-01-05'),
+        'date_batching': 0,
+        'lookback_days': 0
+    }
+
+
+@pytest.fixture
+def make_catalog(reporting_api, base_config):
+    def make_catalog(reports_definition):
+        report = Report(base_config, reports_definition, Client(base_config))
+        report.validate()
+
+        return report.generate_catalog()
+
+    return make_catalog
+
+
+@pytest.fixture
+def run_sync(reporting_api, base_config):
+    """Runs a sync and returns the Singer messages it wrote and its exit code."""
+    from tap_google_analytics.sync import sync
+
+    def run_sync(config, state, catalog):
+        stdout = io.StringIO()
+        exit_code = 0
+
+        with contextlib.redirect_stdout(stdout):
+            try:
+                sync({**base_config, **config}, state, catalog)
+            except SystemExit as e:
+                exit_code = e.code
+
+        messages = [json.loads(line) for line in stdout.getvalue().splitlines() if line.strip()]
+        return messages, exit_code
+
+    return run_sync
+
+
+class FakeCredentials:
+    """OAuth credentials without an expiry, which google-auth always considers valid."""
+    def __init__(self, token):
+        self.token = token
+        self.valid = True
+        self.refresh_count = 0
+
+    def refresh(self, request):
+        self.refresh_count += 1
+        self.token = 'fresh-token'
+
+    def apply(self, headers):
+        headers['authorization'] = 'Bearer {}'.format(self.token)
+
+
+class ReportRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.authorizations.append(self.headers.get('Authorization'))
+
+        if self.headers.get('Authorization') != 'Bearer fresh-token':
+            self.send_response(401)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"error": {"code": 401, "errors": [{"reason": "authError"}]}}')
+            return
+
+        # Like Google, only compress when both the headers ask for it
+        body = self.server.response_body
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', '') and 'gzip' in self.headers.get('User-Agent', '')
+        if compressed:
+            body = gzip.compress(body, compresslevel=1)
+        self.server.compressed.append(compressed)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # Drop the connection halfway through the body
+        if self.server.truncate:
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def report_server(monkeypatch):
+    """
+    Serves `response_body` to the streamed batchGet requests of the Clients
+    in the test, gzip compressed if they ask for it. Only the fresh-token
+    access token is accepted.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ReportRequestHandler)
+    server.daemon_threads = True
+    server.response_body = b'{}'
+    server.truncate = False
+    server.authorizations = []
+    server.compressed = []
+
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    monkeypatch.setattr('tap_google_analytics.client.BATCH_GET_URI', 'http://127.0.0.1:{}/v4/reports:batchGet'.format(server.server_port))
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
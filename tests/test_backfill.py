@@ -0,0 +1,143 @@
+import contextlib
+import io
+import json
+import os
+import time
+
+import pytest
+
+from tap_google_analytics.backfill import Backfill
+
+from conftest import deselect_fields
+
+REPORTS = [
+    {'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions']},
+    {'name': 'segmented', 'dimensions': ['ga:date'], 'metrics': ['ga:users'], 'segment_ids': ['gaid::-1', 'gaid::-2']}
+]
+
+UNIT = {'id': 'sessions-1-2020-01-01-2020-01-01'}
+
+
+@pytest.fixture
+def backfill_config(base_config, tmp_path):
+    return dict(base_config, backfill_dir=str(tmp_path))
+
+
+def make_backfill(backfill_config, **config):
+    backfill = Backfill(dict(backfill_config, **config))
+    backfill.path.joinpath('claims').mkdir(parents=True, exist_ok=True)
+
+    return backfill
+
+
+def abandon_claim(backfill, unit):
+    # Makes a claim look like it wasn't touched for two hours
+    claim_path = backfill.unit_path('claims', unit)
+    os.utime(claim_path, (time.time() - 7200, time.time() - 7200))
+
+
+def test_a_unit_is_claimed_by_a_single_process(backfill_config):
+    first, second = make_backfill(backfill_config), make_backfill(backfill_config)
+
+    assert first.claim(UNIT)
+    assert not second.claim(UNIT)
+    assert first.owns_claim(UNIT) and not second.owns_claim(UNIT)
+
+
+def test_an_abandoned_claim_is_taken_over_once(backfill_config):
+    abandoned, first, second = make_backfill(backfill_config), make_backfill(backfill_config), make_backfill(backfill_config)
+    assert abandoned.claim(UNIT)
+    abandon_claim(abandoned, UNIT)
+
+    assert first.claim(UNIT)
+    assert not second.claim(UNIT)
+    assert first.owns_claim(UNIT)
+    # Only the new claim is left
+    assert [path.name for path in first.path.joinpath('claims').iterdir()] == [UNIT['id']]
+
+
+def test_a_live_claim_moved_by_a_late_take_over_is_given_back(backfill_config):
+    owner, late = make_backfill(backfill_config), make_backfill(backfill_config)
+    assert owner.claim(UNIT)
+
+    # The late process found the claim abandoned just before it was taken over
+    claim_path = late.unit_path('claims', UNIT)
+    real_stat = type(claim_path).stat
+    stale_stat = os.stat_result((0,) * 8 + (time.time() - 7200,) + (0,))
+    checked = []
+
+    def stat(path, *args, **kwargs):
+        if path == claim_path and not checked:
+            checked.append(path)
+            return stale_stat
+        return real_stat(path, *args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(type(claim_path), 'stat', stat)
+        assert not late.claim(UNIT)
+
+    assert owner.owns_claim(UNIT)
+
+
+def test_the_heartbeat_keeps_long_units_claimed(backfill_config):
+    backfill = make_backfill(backfill_config, backfill_claim_timeout=0.2)
+    assert backfill.claim(UNIT)
+    abandon_claim(backfill, UNIT)
+
+    with backfill.heartbeat(UNIT):
+        time.sleep(0.15)
+
+    assert time.time() - backfill.unit_path('claims', UNIT).stat().st_mtime < 0.2
+
+
+def test_plan_work_and_merge(reporting_api, make_catalog, backfill_config):
+    catalog = make_catalog(REPORTS)
+    stdout = io.StringIO()
+
+    with contextlib.redirect_stdout(stdout):
+        Backfill(dict(backfill_config, backfill_mode='plan')).plan({}, catalog)
+        assert not Backfill(dict(backfill_config, backfill_mode='work')).work()
+        Backfill(dict(backfill_config, backfill_mode='merge')).merge()
+
+    with open(os.path.join(backfill_config['backfill_dir'], 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    # The segmented stream has no ga:segment dimension to tell its segments apart
+    assert set(manifest['streams']) == {'sessions'}
+    assert len(manifest['units']) == 5
+
+    with open(os.path.join(backfill_config['backfill_dir'], 'state.json')) as f:
+        state = json.load(f)
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-05']]
+
+    output_files = sorted(os.listdir(os.path.join(backfill_config['backfill_dir'], 'output')))
+    assert len(output_files) == 5 and all(name.endswith('.jsonl') for name in output_files)
+
+
+def test_plan_skips_the_streams_sync_skips(reporting_api, make_catalog, backfill_config, run_sync):
+    catalog = make_catalog(REPORTS + [{'name': 'users', 'dimensions': ['ga:date'], 'metrics': ['ga:users']}])
+    deselect_fields(catalog, 'users', ['ga_users'])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        Backfill(dict(backfill_config, backfill_mode='plan')).plan({}, catalog)
+    messages, exit_code = run_sync({}, {}, catalog)
+
+    with open(os.path.join(backfill_config['backfill_dir'], 'manifest.json')) as f:
+        manifest = json.load(f)
+    synced_stream_ids = {message['stream'] for message in messages if message['type'] == 'SCHEMA'}
+
+    assert exit_code == 1
+    assert set(manifest['streams']) == synced_stream_ids == {'sessions'}
+
+
+def test_work_skips_the_units_of_another_view(reporting_api, make_catalog, backfill_config):
+    catalog = make_catalog(REPORTS[:1])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        Backfill(dict(backfill_config, backfill_mode='plan')).plan({}, catalog)
+        assert Backfill(dict(backfill_config, backfill_mode='work', view_id='2')).work()
+
+    # No unit was claimed nor fetched, they are left for a process configured for view 1
+    assert reporting_api.requests == []
+    assert os.listdir(os.path.join(backfill_config['backfill_dir'], 'claims')) == []
+    assert os.listdir(os.path.join(backfill_config['backfill_dir'], 'done')) == []
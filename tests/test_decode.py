@@ -0,0 +1,66 @@
+from tap_google_analytics.client import Client, decode_rows
+
+from conftest import utc_date
+
+
+def make_response(row_count):
+    return {
+        'reports': [{
+            'columnHeader': {
+                'dimensions': ['ga:date', 'ga:source'],
+                'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions'}, {'name': 'ga:bounceRate'}]}
+            },
+            'data': {
+                'rows': [
+                    {'dimensions': ['20200101', 'source{}'.format(i)], 'metrics': [{'values': [str(i), '1.5']}]}
+                    for i in range(row_count)
+                ]
+            },
+            'nextPageToken': '2'
+        }]
+    }
+
+
+def without_timestamps(records):
+    return [{key: value for key, value in record.items() if key != '_sdc_record_timestamp'} for record in records]
+
+
+def test_decode_rows_casts_and_renames_values():
+    records = decode_rows(
+        [{'dimensions': ['20200101', 'google'], 'metrics': [{'values': ['12', '0.25']}]}],
+        '1', ['ga:date', 'ga:source'], ['string', 'string'], ['ga:sessions', 'ga:bounceRate'], ['integer', 'number'],
+        '2020-01-01T00:00:00', '2020-01-01T00:00:00'
+    )
+
+    assert len(records) == 1
+    assert records[0]['ga_date'] == '20200101'
+    assert records[0]['ga_source'] == 'google'
+    assert records[0]['ga_sessions'] == 12
+    assert records[0]['ga_bounceRate'] == 0.25
+    assert records[0]['report_start_date'] == '2020-01-01T00:00:00'
+    assert records[0]['_sdc_record_hash']
+
+
+def test_decode_rows_hashes_the_report_date_without_a_date_dimension():
+    args = ('1', ['ga:source'], ['string'], ['ga:sessions'], ['integer'])
+    first_day = decode_rows([{'dimensions': ['google'], 'metrics': [{'values': ['1']}]}], *args, '2020-01-01', '2020-01-01')
+    second_day = decode_rows([{'dimensions': ['google'], 'metrics': [{'values': ['1']}]}], *args, '2020-01-02', '2020-01-02')
+
+    assert first_day[0]['_sdc_record_hash'] != second_day[0]['_sdc_record_hash']
+
+
+def test_decode_pool_keeps_the_records_and_their_order(reporting_api, base_config):
+    date = utc_date('2020-01-01')
+    serial_client = Client(base_config)
+    pooled_client = Client(dict(base_config, decode_workers=2, decode_chunk_size=100))
+
+    try:
+        serial_token, serial_records = serial_client.process_response(date, date, make_response(1050))
+        pooled_token, pooled_records = pooled_client.process_response(date, date, make_response(1050))
+        assert pooled_client.decode_pool is not None
+    finally:
+        pooled_client.close()
+
+    assert pooled_client.decode_pool is None
+    assert serial_token == pooled_token == '2'
+    assert without_timestamps(pooled_records) == without_timestamps(serial_records)
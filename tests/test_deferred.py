@@ -0,0 +1,60 @@
+from tap_google_analytics.error import GaBackendServerError, GaQuotaExceededError
+from tap_google_analytics.quota import QuotaLedger
+
+REPORTS = [{'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions', 'ga:users']}]
+
+RETRY_CONFIG = {'deferred_retry_attempts': 2, 'deferred_retry_delay': 0}
+
+
+def fail_times(count, date_string):
+    # Fails the first `count` requests of the batch starting on the given date
+    failures = []
+
+    def predicate(start_date, end_date, metrics):
+        if start_date.strftime('%Y-%m-%d') != date_string or len(failures) >= count:
+            return False
+        failures.append(start_date)
+        return True
+
+    return predicate
+
+
+def test_deferred_batch_is_completed_by_its_retry(reporting_api, make_catalog, run_sync):
+    catalog = make_catalog(REPORTS)
+    reporting_api.fail(GaBackendServerError('Backend error'), fail_times(1, '2020-01-02'))
+
+    state = {}
+    messages, exit_code = run_sync(RETRY_CONFIG, state, catalog)
+
+    assert exit_code == 0
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-05']]
+    # The retry comes after all the other batches
+    assert [request[0] for request in reporting_api.requests] == ['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-04', '2020-01-05', '2020-01-02']
+    assert sorted({message['record']['ga_date'] for message in messages if message['type'] == 'RECORD'}) == ['20200101', '20200102', '20200103', '20200104', '20200105']
+
+
+def test_deferred_retries_stop_after_too_many_failures_in_a_row(reporting_api, make_catalog, run_sync):
+    catalog = make_catalog(REPORTS)
+    reporting_api.fail(GaBackendServerError('Backend error'), lambda start_date, end_date, metrics: start_date.day > 1)
+
+    state = {}
+    _, exit_code = run_sync(dict(RETRY_CONFIG, deferred_retry_max_failures=2), state, catalog)
+
+    assert exit_code == 1
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-01']]
+    # 5 batches in the main loop, then 2 attempts for each of the first 2 deferred batches
+    assert len(reporting_api.requests) == 5 + 2 * 2
+
+
+def test_deferred_retries_stop_once_the_quota_is_exhausted(reporting_api, make_catalog, run_sync, base_config, tmp_path):
+    catalog = make_catalog(REPORTS)
+    reporting_api.fail(GaQuotaExceededError('Quota exceeded'))
+    config = dict(RETRY_CONFIG, deferred_retry_attempts=3, deferred_retry_max_failures=5,
+                  quota_ledger=str(tmp_path / 'ledger.json'), quota_view_daily_limit=16, quota_reserve=10)
+
+    _, exit_code = run_sync(config, {}, catalog)
+
+    assert exit_code == 0
+    # Requests stop once no more than quota_reserve of the daily limit is left
+    assert QuotaLedger(dict(base_config, **config)).update() == (6, 6)
+    assert len(reporting_api.requests) == 6
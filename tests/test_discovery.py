@@ -0,0 +1,38 @@
+import json
+import threading
+
+import httplib2
+from google.auth.credentials import AnonymousCredentials
+
+import tap_google_analytics.client
+from tap_google_analytics.client import DiscoveryCache, build_service
+
+DISCOVERY_DOCUMENT = {
+    'kind': 'discovery#restDescription',
+    'name': 'analyticsreporting',
+    'version': 'v4',
+    'rootUrl': 'https://analyticsreporting.googleapis.com/',
+    'servicePath': '',
+    'schemas': {},
+    'resources': {}
+}
+
+
+def test_discovery_document_is_fetched_once_for_all_threads(monkeypatch):
+    monkeypatch.setattr(tap_google_analytics.client, 'DISCOVERY_CACHE', DiscoveryCache())
+    fetched_urls = []
+
+    def request(http, uri, *args, **kwargs):
+        fetched_urls.append(uri)
+        return httplib2.Response({'status': 200}), json.dumps(DISCOVERY_DOCUMENT).encode('utf-8')
+
+    monkeypatch.setattr(httplib2.Http, 'request', request)
+
+    services = [build_service('analyticsreporting', 'v4', AnonymousCredentials())]
+    thread = threading.Thread(target=lambda: services.append(build_service('analyticsreporting', 'v4', AnonymousCredentials())))
+    thread.start()
+    thread.join()
+
+    assert len(fetched_urls) == 1
+    # Every service object still gets its own http transport
+    assert services[0]._http is not services[1]._http
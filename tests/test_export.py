@@ -0,0 +1,70 @@
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from tap_google_analytics.helpers import DATE_BATCHING_INTERVALS
+from tap_google_analytics.sync import align_report_dates
+
+from conftest import utc_date
+
+parquet = pytest.importorskip('pyarrow.parquet')
+
+REPORTS = [{'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions', 'ga:users']}]
+
+
+def exported_files(export_path):
+    files = {}
+    for path in sorted(Path(export_path, 'sessions').glob('*/*.parquet')):
+        start_date_string, _, end_date_string = path.stem.partition('_')
+        files[(start_date_string, end_date_string)] = parquet.read_table(path).column('ga_date').to_pylist()
+
+    return files
+
+
+def test_align_report_dates_uses_the_same_batches_for_any_range():
+    week = DATE_BATCHING_INTERVALS['WEEK']
+    min_date, max_date = utc_date('2020-01-01'), utc_date('2020-02-01')
+
+    full = list(align_report_dates(min_date, max_date, week, min_date, max_date))
+    partial = list(align_report_dates(utc_date('2020-01-16'), utc_date('2020-01-17'), week, min_date, max_date))
+
+    assert len(partial) == 1
+    assert partial[0] in full
+    assert partial[0][0] <= utc_date('2020-01-16') and partial[0][1] >= utc_date('2020-01-17')
+    # The batches are contiguous and clipped to min_date and max_date
+    assert full[0][0] == min_date and full[-1][1] == max_date
+    assert all(end_date + timedelta(days=1) == next_start_date for (_, end_date), (next_start_date, _) in zip(full, full[1:]))
+
+
+def test_lookback_overwrites_the_earlier_export_files(reporting_api, make_catalog, run_sync, tmp_path):
+    # Nothing is golden, so the lookback window is refetched
+    reporting_api.golden_until = '2019-12-31'
+    catalog = make_catalog(REPORTS)
+    config = {
+        'export_format': 'parquet',
+        'export_path': str(tmp_path),
+        'date_batching': DATE_BATCHING_INTERVALS['WEEK'],
+        'start_date': utc_date('2020-01-01'),
+        'end_date': utc_date('2020-01-12')
+    }
+    state = {}
+
+    _, exit_code = run_sync(config, state, catalog)
+    assert exit_code == 0
+
+    messages, exit_code = run_sync(dict(config, end_date=utc_date('2020-01-20'), lookback_days=4), state, catalog)
+    assert exit_code == 0
+
+    files = exported_files(tmp_path)
+    dates = sorted(set(date for file_dates in files.values() for date in file_dates))
+
+    # Every date is exported in a single file
+    assert [start_date_string for start_date_string, _ in files] == sorted(set(start_date_string for start_date_string, _ in files))
+    assert sum(len(set(file_dates)) for file_dates in files.values()) == len(dates)
+    assert dates[0] == '20200101' and dates[-1] == '20200120'
+
+    manifest = [message for message in messages if message['type'] == 'MANIFEST'][0]
+    replaced = [path for entry in manifest['streams']['sessions'] for path in entry['replaces']]
+    assert len(replaced) == 1
+    assert not Path(replaced[0]).exists()
@@ -0,0 +1,73 @@
+import pytest
+
+from tap_google_analytics.client import Client
+
+SOURCE_FILTER = {'dimensionFilterClauses': [{'filters': [{'dimensionName': 'ga:source', 'operator': 'IN_LIST', 'expressions': ['google', 'bing']}]}]}
+SESSIONS_FILTER = {'metricFilterClauses': [{'filters': [{'metricName': 'ga:sessions', 'operator': 'GREATER_THAN', 'comparisonValue': '0'}]}]}
+
+
+def make_report(name, metrics, **filters):
+    return dict({'name': name, 'dimensions': ['ga:date', 'ga:source'], 'metrics': metrics}, **filters)
+
+
+@pytest.fixture
+def request_bodies(reporting_api, monkeypatch):
+    """Records the body of every reportRequest sent to the fake API."""
+    bodies = []
+
+    def query_api(client, start_date, end_date, report_definition, pageToken=None, segment_ids=None):
+        bodies.append(client.build_request_body(start_date, end_date, report_definition, pageToken, segment_ids)['reportRequests'][0])
+        return reporting_api.batch_get(start_date, end_date, report_definition, segment_ids)
+
+    monkeypatch.setattr(Client, 'query_api', query_api)
+
+    return bodies
+
+
+def test_filters_are_sent_with_every_request(request_bodies, make_catalog, run_sync):
+    filters = dict(SOURCE_FILTER, **SESSIONS_FILTER, filtersExpression='ga:browser!~bot')
+    catalog = make_catalog([make_report('sessions', ['ga:sessions'], **filters)])
+
+    _, exit_code = run_sync({}, {}, catalog)
+
+    assert exit_code == 0
+    assert len(request_bodies) == 5
+    for body in request_bodies:
+        assert {key: body[key] for key in filters} == filters
+
+
+@pytest.mark.parametrize('filters', [
+    {'filtersExpression': ''},
+    {'dimensionFilterClauses': {'filters': []}},
+    {'dimensionFilterClauses': [{'operator': 'XOR', 'filters': [{'dimensionName': 'ga:source', 'expressions': ['google']}]}]},
+    {'dimensionFilterClauses': [{'filters': [{'dimensionName': 'ga:source', 'operator': 'LIKE', 'expressions': ['google']}]}]},
+    {'dimensionFilterClauses': [{'filters': [{'dimensionName': 'ga:browserSize', 'expressions': ['1x1']}]}]},
+    {'metricFilterClauses': [{'filters': [{'metricName': 'ga:sessions', 'operator': 'BEGINS_WITH', 'comparisonValue': '1'}]}]},
+    {'metricFilterClauses': [{'filters': [{'metricName': 'ga:revenue', 'comparisonValue': '1'}]}]},
+    {'metricFilterClauses': [{'filters': [{'comparisonValue': '1'}]}]}
+])
+def test_invalid_filters_fail_the_discovery(make_catalog, filters):
+    with pytest.raises(SystemExit) as e:
+        make_catalog([make_report('sessions', ['ga:sessions'], **filters)])
+
+    assert e.value.code == 1
+
+
+def test_streams_are_only_merged_with_the_same_filters(request_bodies, make_catalog, run_sync):
+    catalog = make_catalog([
+        make_report('sessions', ['ga:sessions'], **SOURCE_FILTER),
+        make_report('users', ['ga:users'], **SOURCE_FILTER),
+        make_report('pageviews', ['ga:pageviews'], **SESSIONS_FILTER)
+    ])
+
+    _, exit_code = run_sync({}, {}, catalog)
+
+    assert exit_code == 0
+    assert len(request_bodies) == 10
+    for body in request_bodies:
+        metrics = [metric['expression'] for metric in body['metrics']]
+        if metrics == ['ga:pageviews']:
+            assert body['metricFilterClauses'] == SESSIONS_FILTER['metricFilterClauses'] and 'dimensionFilterClauses' not in body
+        else:
+            assert metrics == ['ga:sessions', 'ga:users']
+            assert body['dimensionFilterClauses'] == SOURCE_FILTER['dimensionFilterClauses'] and 'metricFilterClauses' not in body
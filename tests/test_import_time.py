@@ -0,0 +1,66 @@
+"""
+Keeps the startup of the CLI fast: the Google API libraries are slow to
+import, so they must only be imported once a Client is needed.
+
+Budgets are in seconds of import time on top of singer-python, which the
+tap can't do without.
+"""
+import subprocess
+import sys
+
+HELP_BUDGET = 0.1
+
+DISCOVER_BUDGET = 1.0
+
+# Never needed to print the usage
+HELP_FORBIDDEN_MODULES = ['googleapiclient', 'google.oauth2', 'google_auth_httplib2', 'httplib2', 'pyarrow', 'ijson']
+
+# Only needed to export or to stream responses
+DISCOVER_FORBIDDEN_MODULES = ['pyarrow', 'ijson']
+
+RUN_HELP = "import sys; sys.argv = ['tap-google-analytics', '--help']; import tap_google_analytics; tap_google_analytics.main()"
+
+# What `--discover` imports before it sends its first request
+IMPORT_DISCOVER = "import tap_google_analytics, tap_google_analytics.discover, google.oauth2.service_account, googleapiclient.discovery, google_auth_httplib2"
+
+
+def import_times(code):
+    """
+    Runs code with `python -X importtime` and returns the total import time
+    and the cumulative import time of every module, in seconds.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    total = 0
+    modules = {}
+
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.setdefault(name.strip(), int(cumulative) / 1e6)
+        # Top level imports are indented by a single space
+        if not name.startswith('  '):
+            total += int(cumulative) / 1e6
+
+    return total, modules
+
+
+def imported(modules, package):
+    return sorted(name for name in modules if name == package or name.startswith(package + '.'))
+
+
+def test_help_import_time():
+    total, modules = import_times(RUN_HELP)
+
+    for package in HELP_FORBIDDEN_MODULES:
+        assert not imported(modules, package)
+    assert total - modules['singer'] < HELP_BUDGET
+
+
+def test_discover_import_time():
+    total, modules = import_times(IMPORT_DISCOVER)
+
+    for package in DISCOVER_FORBIDDEN_MODULES:
+        assert not imported(modules, package)
+    assert total - modules['singer'] < DISCOVER_BUDGET
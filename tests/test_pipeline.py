@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from tap_google_analytics.error import GaBackendServerError
+from tap_google_analytics.pipeline import FetchPipeline
+
+
+def date_batches(batches, fetched=None):
+    # (group, index, pages, report_status) tuples, like fetch_date_batches()
+    for index, pages in enumerate(batches):
+        def iterate_pages(pages=pages, index=index):
+            for page in pages:
+                if isinstance(page, Exception):
+                    raise page
+                if fetched is not None:
+                    fetched.append((index, page))
+                yield page
+
+        yield 'group', index, iterate_pages(), None
+
+
+def test_pipeline_keeps_the_planned_order():
+    batches = [[[1], [2]], [], [[3]]]
+
+    pipeline = FetchPipeline(date_batches(batches), 1)
+    try:
+        result = [(index, list(pages)) for _, index, pages, _ in pipeline]
+    finally:
+        pipeline.close()
+
+    assert result == [(0, [[1], [2]]), (1, []), (2, [[3]])]
+
+
+def test_batch_errors_are_raised_with_their_pages():
+    batches = [[[1], GaBackendServerError('dropped')], [[2]]]
+
+    pipeline = FetchPipeline(date_batches(batches), 4)
+    try:
+        iterator = iter(pipeline)
+        _, _, pages, _ = next(iterator)
+        assert next(pages) == [1]
+        with pytest.raises(GaBackendServerError):
+            next(pages)
+
+        # The next batches are still fetched
+        _, index, pages, _ = next(iterator)
+        assert (index, list(pages)) == (1, [[2]])
+    finally:
+        pipeline.close()
+
+
+def test_unconsumed_pages_are_skipped():
+    batches = [[[1], [2]], [[3]]]
+
+    pipeline = FetchPipeline(date_batches(batches), 1)
+    try:
+        result = [(index, list(pages)) for _, index, pages, _ in pipeline if index == 1]
+    finally:
+        pipeline.close()
+
+    assert result == [(1, [[3]])]
+
+
+def test_close_stops_a_producer_waiting_on_a_full_queue():
+    fetched = []
+    batches = [[[page] for page in range(100)]]
+
+    pipeline = FetchPipeline(date_batches(batches, fetched), 2)
+    _, _, pages, _ = next(iter(pipeline))
+    next(pages)
+
+    closer = threading.Thread(target=pipeline.close)
+    closer.start()
+    closer.join(timeout=5)
+
+    assert not closer.is_alive()
+    assert len(fetched) < 10
+
+
+def test_pipelined_sync_writes_the_same_messages(make_catalog, run_sync):
+    catalog = make_catalog([
+        {'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions']},
+        {'name': 'mediums', 'dimensions': ['ga:date', 'ga:medium'], 'metrics': ['ga:users']}
+    ])
+
+    def without_timestamps(messages):
+        return [
+            dict(message, record={key: value for key, value in message['record'].items() if key != '_sdc_record_timestamp'})
+            if message['type'] == 'RECORD' else message
+            for message in messages
+        ]
+
+    sequential_messages, exit_code = run_sync({}, {}, catalog)
+    assert exit_code == 0
+    pipelined_messages, exit_code = run_sync({'pipeline_queue_size': 2}, {}, catalog)
+    assert exit_code == 0
+
+    assert without_timestamps(pipelined_messages) == without_timestamps(sequential_messages)
@@ -0,0 +1,94 @@
+from tap_google_analytics.sync import (add_completed_range, get_sync_ranges, is_range_completed,
+                                       load_completed_ranges, merge_ranges, subtract_range)
+
+from conftest import utc_date
+
+
+def date_range(start_date_string, end_date_string):
+    return utc_date(start_date_string), utc_date(end_date_string)
+
+
+def test_merge_ranges_joins_overlapping_and_adjacent_ranges():
+    assert merge_ranges([
+        date_range('2020-01-10', '2020-01-12'),
+        date_range('2020-01-01', '2020-01-03'),
+        date_range('2020-01-04', '2020-01-05'),
+        date_range('2020-01-11', '2020-01-15'),
+        date_range('2020-01-20', '2020-01-20')
+    ]) == [
+        date_range('2020-01-01', '2020-01-05'),
+        date_range('2020-01-10', '2020-01-15'),
+        date_range('2020-01-20', '2020-01-20')
+    ]
+
+
+def test_subtract_range_splits_and_trims_ranges():
+    ranges = [date_range('2020-01-01', '2020-01-10'), date_range('2020-01-20', '2020-01-25')]
+
+    assert subtract_range(ranges, *date_range('2020-01-04', '2020-01-06')) == [
+        date_range('2020-01-01', '2020-01-03'),
+        date_range('2020-01-07', '2020-01-10'),
+        date_range('2020-01-20', '2020-01-25')
+    ]
+    assert subtract_range(ranges, *date_range('2020-01-08', '2020-01-22')) == [
+        date_range('2020-01-01', '2020-01-07'),
+        date_range('2020-01-23', '2020-01-25')
+    ]
+    assert subtract_range(ranges, *date_range('2019-12-01', '2020-02-01')) == []
+
+
+def test_completed_ranges_are_merged_in_the_bookmarks():
+    state = {'bookmarks': {}}
+    start_date = utc_date('2020-01-01')
+
+    add_completed_range(state, ['sessions'], *date_range('2020-01-04', '2020-01-05'), start_date)
+    # The dates before the completed range aren't synced yet
+    assert 'last_report_date' not in state['bookmarks']['sessions']
+
+    add_completed_range(state, ['sessions'], *date_range('2020-01-01', '2020-01-02'), start_date)
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-02'], ['2020-01-04', '2020-01-05']]
+    assert state['bookmarks']['sessions']['last_report_date'] == '2020-01-02'
+    assert not is_range_completed(state, ['sessions'], *date_range('2020-01-01', '2020-01-05'))
+
+    add_completed_range(state, ['sessions'], *date_range('2020-01-03', '2020-01-03'), start_date)
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-05']]
+    assert state['bookmarks']['sessions']['last_report_date'] == '2020-01-05'
+    assert is_range_completed(state, ['sessions'], *date_range('2020-01-01', '2020-01-05'))
+
+
+def test_last_report_date_is_not_moved_past_a_gap_at_the_start():
+    # The start date was moved back, so the dates before the completed ones have to be synced
+    state = {'bookmarks': {'sessions': {'completed_ranges': [['2020-01-01', '2020-01-10']], 'last_report_date': '2020-01-10'}}}
+    start_date = utc_date('2019-12-01')
+
+    add_completed_range(state, ['sessions'], *date_range('2020-01-11', '2020-01-12'), start_date)
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-12']]
+    assert state['bookmarks']['sessions']['last_report_date'] == '2020-01-10'
+
+
+def test_legacy_bookmarks_are_converted_to_completed_ranges():
+    state = {'bookmarks': {'sessions': {
+        'last_report_date': '2020-01-10',
+        'failed_batches': [['2020-01-03', '2020-01-04']]
+    }}}
+    config = {'start_date': utc_date('2020-01-01'), 'end_date': utc_date('2020-01-15'), 'lookback_days': 2}
+
+    assert load_completed_ranges(state, 'sessions', config['start_date']) == [
+        date_range('2020-01-01', '2020-01-02'),
+        date_range('2020-01-05', '2020-01-10')
+    ]
+
+    # The failed batch, the lookback window and the new dates are synced
+    assert get_sync_ranges(config, state, 'sessions') == [
+        date_range('2020-01-03', '2020-01-04'),
+        date_range('2020-01-08', '2020-01-15')
+    ]
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-02'], ['2020-01-05', '2020-01-10']]
+    assert 'failed_batches' not in state['bookmarks']['sessions']
+
+
+def test_lookback_starts_after_the_last_golden_date():
+    state = {'bookmarks': {'sessions': {'completed_ranges': [['2020-01-01', '2020-01-10']], 'last_golden_date': '2020-01-08'}}}
+    config = {'start_date': utc_date('2020-01-01'), 'end_date': utc_date('2020-01-12'), 'lookback_days': 5}
+
+    assert get_sync_ranges(config, state, 'sessions') == [date_range('2020-01-09', '2020-01-12')]
@@ -0,0 +1,34 @@
+from tap_google_analytics.client import Client
+
+from conftest import utc_date
+
+STREAM = {'dimensions': ['ga_date', 'ga_segment'], 'metrics': ['ga_sessions'], 'segment_concurrency': 2}
+
+SEGMENT_IDS = ['gaid::-{}'.format(i) for i in range(1, 9)]
+
+
+def test_segments_are_requested_in_chunks_of_four(reporting_api, base_config):
+    client = Client(base_config)
+    date = utc_date('2020-01-01')
+
+    try:
+        pages = list(client.iterate_stream_pages(date, date, STREAM, SEGMENT_IDS))
+    finally:
+        client.close()
+
+    assert len(reporting_api.requests) == 2
+    assert len(pages) == 2
+
+
+def test_segment_threads_are_reused_across_date_batches(reporting_api, base_config):
+    client = Client(base_config)
+
+    try:
+        for day in ['2020-01-01', '2020-01-02', '2020-01-03']:
+            list(client.iterate_stream_pages(utc_date(day), utc_date(day), STREAM, SEGMENT_IDS))
+    finally:
+        client.close()
+
+    assert len(reporting_api.requests) == 6
+    assert len(reporting_api.threads) <= STREAM['segment_concurrency']
+    assert client.segment_executors == {}
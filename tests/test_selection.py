@@ -0,0 +1,53 @@
+from conftest import deselect_fields
+
+REPORTS = [{'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions', 'ga:users', 'ga:pageviews']}]
+
+
+def records_by_dimensions(messages):
+    return {
+        (message['record']['ga_date'], message['record']['ga_source']): message['record']
+        for message in messages
+        if message['type'] == 'RECORD'
+    }
+
+
+def test_deselected_metric_is_left_out(reporting_api, make_catalog, run_sync):
+    full_messages, exit_code = run_sync({}, {}, make_catalog(REPORTS))
+    assert exit_code == 0
+    reporting_api.requests.clear()
+
+    messages, exit_code = run_sync({}, {}, deselect_fields(make_catalog(REPORTS), 'sessions', ['ga_users']))
+
+    assert exit_code == 0
+    assert {request[2] for request in reporting_api.requests} == {('ga:sessions', 'ga:pageviews')}
+
+    schema = next(message['schema'] for message in messages if message['type'] == 'SCHEMA')
+    assert 'ga_users' not in schema['properties']
+    assert {'ga_sessions', 'ga_pageviews', 'ga_date', 'ga_source', '_sdc_record_hash'} <= set(schema['properties'])
+
+    # The records keep the same hash, as it only depends on the dimensions
+    full_records = records_by_dimensions(full_messages)
+    records = records_by_dimensions(messages)
+    assert records
+    for dimensions, record in records.items():
+        assert 'ga_users' not in record
+        assert record['ga_sessions'] == full_records[dimensions]['ga_sessions']
+        assert record['_sdc_record_hash'] == full_records[dimensions]['_sdc_record_hash']
+
+
+def test_metrics_of_older_catalogs_are_always_synced(reporting_api, make_catalog, run_sync):
+    catalog = make_catalog(REPORTS)
+    # Catalogs discovered before metrics could be deselected include them automatically
+    for entry in catalog['streams'][0]['metadata']:
+        if entry['metadata'].get('ga_type') == 'metric':
+            entry['metadata']['inclusion'] = 'automatic'
+            entry['metadata'].pop('selected-by-default', None)
+            entry['metadata'].pop('selected', None)
+
+    messages, exit_code = run_sync({}, {}, catalog)
+
+    assert exit_code == 0
+    assert {request[2] for request in reporting_api.requests} == {('ga:sessions', 'ga:users', 'ga:pageviews')}
+    schema = next(message['schema'] for message in messages if message['type'] == 'SCHEMA')
+    assert {'ga_sessions', 'ga_users', 'ga_pageviews'} <= set(schema['properties'])
+    assert all({'ga_sessions', 'ga_users', 'ga_pageviews'} <= set(record) for record in records_by_dimensions(messages).values())
@@ -0,0 +1,139 @@
+import contextlib
+import json
+import socket
+import sys
+import threading
+
+import pytest
+
+from tap_google_analytics.error import GaAuthenticationError
+from tap_google_analytics.server import SyncServer, ThreadLocalStdout
+
+JOB_CONFIG = {
+    'view_id': '1',
+    'oauth_credentials': {'access_token': 'token', 'refresh_token': 'refresh', 'client_id': 'client', 'client_secret': 'secret'},
+    'start_date': '2020-01-01T00:00:00Z',
+    'end_date': '2020-01-05T00:00:00Z',
+    'lookback_days': 0
+}
+
+SESSIONS_REPORT = {'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions']}
+PAGEVIEWS_REPORT = {'name': 'pageviews', 'dimensions': ['ga:date', 'ga:medium'], 'metrics': ['ga:pageviews']}
+
+
+@pytest.fixture
+def sync_server(reporting_api, tmp_path):
+    server = SyncServer(str(tmp_path / 'tap.sock'), 4)
+
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@contextlib.contextmanager
+def thread_local_stdout():
+    # Like serve(). pytest swaps sys.stdout between the test phases, so it is set in the test itself
+    stdout = sys.stdout
+    sys.stdout = ThreadLocalStdout(stdout)
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def send_job(server, job):
+    """Sends a job to the server and returns the messages it streamed back."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(server.server_address)
+        connection.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        with connection.makefile('r', encoding='utf-8') as output:
+            return [json.loads(line) for line in output if line.strip()]
+
+
+def run_job(server, job):
+    with thread_local_stdout():
+        return send_job(server, job)
+
+
+def run_jobs(server, jobs):
+    # Runs the jobs over concurrent connections
+    outputs = [None] * len(jobs)
+
+    def run(index):
+        outputs[index] = send_job(server, jobs[index])
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(jobs))]
+    with thread_local_stdout():
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return outputs
+
+
+def wait_for_each_other(reporting_api, job_count):
+    # Holds the first request of the first `job_count` jobs until all of them are syncing
+    barrier = threading.Barrier(job_count, timeout=10)
+    batch_get = reporting_api.batch_get
+    lock = threading.Lock()
+    waited = set()
+
+    def synchronized_batch_get(*args, **kwargs):
+        with lock:
+            wait = len(waited) < job_count and threading.current_thread().name not in waited
+            waited.add(threading.current_thread().name)
+        if wait:
+            barrier.wait()
+        return batch_get(*args, **kwargs)
+
+    reporting_api.batch_get = synchronized_batch_get
+
+
+def streams_of(messages):
+    return {message['stream'] for message in messages if message['type'] in ['SCHEMA', 'RECORD']}
+
+
+def records_of(messages):
+    return [
+        {key: value for key, value in message['record'].items() if key != '_sdc_record_timestamp'}
+        for message in messages
+        if message['type'] == 'RECORD'
+    ]
+
+
+def test_concurrent_jobs_get_their_own_output(sync_server, reporting_api, make_catalog):
+    sessions_job = {'config': JOB_CONFIG, 'state': {}, 'catalog': make_catalog([SESSIONS_REPORT])}
+    pageviews_job = {'config': JOB_CONFIG, 'state': {}, 'catalog': make_catalog([PAGEVIEWS_REPORT])}
+    expected_outputs = [run_job(sync_server, sessions_job), run_job(sync_server, pageviews_job)]
+
+    wait_for_each_other(reporting_api, 2)
+    outputs = run_jobs(sync_server, [sessions_job, pageviews_job])
+
+    assert [streams_of(output) for output in outputs] == [{'sessions'}, {'pageviews'}]
+    for output, expected_output in zip(outputs, expected_outputs):
+        assert records_of(output) and records_of(output) == records_of(expected_output)
+        assert output[-2]['type'] == 'STATE'
+        assert output[-1] == {'type': 'EXIT', 'code': 0}
+
+
+def test_failing_job_returns_its_exit_code(sync_server, reporting_api, make_catalog):
+    wait_for_each_other(reporting_api, 2)
+    reporting_api.fail(GaAuthenticationError('Invalid credentials'), lambda start_date, end_date, metrics: 'ga:pageviews' in metrics)
+    sessions_job = {'config': JOB_CONFIG, 'state': {}, 'catalog': make_catalog([SESSIONS_REPORT])}
+    pageviews_job = {'config': JOB_CONFIG, 'state': {}, 'catalog': make_catalog([PAGEVIEWS_REPORT])}
+
+    sessions_output, pageviews_output = run_jobs(sync_server, [sessions_job, pageviews_job])
+
+    assert sessions_output[-1] == {'type': 'EXIT', 'code': 0}
+    assert pageviews_output[-1] == {'type': 'EXIT', 'code': 1}
+    assert streams_of(pageviews_output) == {'pageviews'}
+
+    # An invalid config fails the job before it starts, and the server keeps running
+    invalid_output = run_job(sync_server, {'config': dict(JOB_CONFIG, view_id=''), 'state': {}, 'catalog': sessions_job['catalog']})
+    assert invalid_output == [{'type': 'EXIT', 'code': 1}]
+    assert run_job(sync_server, sessions_job)[-1] == {'type': 'EXIT', 'code': 0}
@@ -0,0 +1,40 @@
+from tap_google_analytics.error import GaAuthenticationError
+
+from conftest import utc_date
+
+REPORTS = [
+    {'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions']},
+    {'name': 'mediums', 'dimensions': ['ga:date', 'ga:medium'], 'metrics': ['ga:users']}
+]
+
+
+def state_messages(messages):
+    return [message['value'] for message in messages if message['type'] == 'STATE']
+
+
+def test_state_is_emitted_after_every_batch_by_default(make_catalog, run_sync):
+    messages, exit_code = run_sync({}, {}, make_catalog(REPORTS[:1]))
+
+    assert exit_code == 0
+    # One per batch, plus the final one
+    assert len(state_messages(messages)) == 6
+
+
+def test_interleaved_streams_keep_the_state_coalesced(make_catalog, run_sync):
+    config = {'end_date': utc_date('2020-01-10'), 'quota_priority': 'most_recent_first', 'state_emit_every_batches': 5}
+
+    messages, exit_code = run_sync(config, {}, make_catalog(REPORTS))
+
+    assert exit_code == 0
+    # 20 batches: every 5 batches, at the end of each stream and at the end of the run
+    assert len(state_messages(messages)) == 6
+    assert state_messages(messages)[-1]['bookmarks']['mediums']['completed_ranges'] == [['2020-01-01', '2020-01-10']]
+
+
+def test_pending_state_is_flushed_before_an_authentication_error_exit(reporting_api, make_catalog, run_sync):
+    reporting_api.fail(GaAuthenticationError('Invalid credentials'), lambda start_date, end_date, metrics: start_date >= utc_date('2020-01-04'))
+
+    messages, exit_code = run_sync({'state_emit_every_batches': 10}, {}, make_catalog(REPORTS[:1]))
+
+    assert exit_code == 1
+    assert state_messages(messages)[-1]['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-03']]
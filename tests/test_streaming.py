@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from tap_google_analytics.client import Client
+from tap_google_analytics.error import GaBackendServerError
+
+from conftest import FakeCredentials, utc_date
+from test_decode import make_response, without_timestamps
+
+pytest.importorskip('requests')
+pytest.importorskip('ijson')
+
+STREAM = {'dimensions': ['ga_date', 'ga_source'], 'metrics': ['ga_sessions', 'ga_bounceRate']}
+
+
+def make_response_body(row_count):
+    # A single page response, without a nextPageToken
+    response = make_response(row_count)
+    del response['reports'][0]['nextPageToken']
+
+    return json.dumps(response).encode('utf-8')
+
+
+def make_streaming_client(base_config, token='fresh-token'):
+    client = Client(dict(base_config, stream_responses=True, decode_chunk_size=100))
+    client.credentials = FakeCredentials(token)
+
+    return client
+
+
+def test_streamed_pages_match_the_parsed_pages(reporting_api, report_server, base_config):
+    date = utc_date('2020-01-01')
+    report_server.response_body = make_response_body(250)
+
+    client = make_streaming_client(base_config)
+    pages = list(client.iterate_report_pages(date, date, STREAM, None))
+    _, records = client.process_response(date, date, json.loads(report_server.response_body))
+
+    # Records come in chunks of decode_chunk_size rows
+    assert [len(page) for page in pages] == [100, 100, 50]
+    assert without_timestamps([record for page in pages for record in page]) == without_timestamps(records)
+
+
+def test_streamed_responses_are_gzip_compressed(reporting_api, report_server, base_config):
+    date = utc_date('2020-01-01')
+    report_server.response_body = make_response_body(10)
+
+    client = make_streaming_client(base_config)
+    pages = list(client.iterate_report_pages(date, date, STREAM, None))
+
+    assert sum(len(page) for page in pages) == 10
+    assert report_server.compressed == [True]
+
+
+def test_stale_oauth_token_is_refreshed_once_rejected(reporting_api, report_server, base_config):
+    date = utc_date('2020-01-01')
+    report_server.response_body = make_response_body(10)
+
+    client = make_streaming_client(base_config, token='stale-token')
+    pages = list(client.iterate_report_pages(date, date, STREAM, None))
+
+    assert sum(len(page) for page in pages) == 10
+    assert client.credentials.refresh_count == 1
+    assert report_server.authorizations == ['Bearer stale-token', 'Bearer fresh-token']
+
+
+def test_connection_dropped_while_streaming_is_a_backend_error(reporting_api, report_server, base_config):
+    date = utc_date('2020-01-01')
+    report_server.response_body = make_response_body(5000)
+    report_server.truncate = True
+
+    client = make_streaming_client(base_config)
+    with pytest.raises(GaBackendServerError):
+        list(client.iterate_report_pages(date, date, STREAM, None))
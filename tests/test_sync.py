@@ -0,0 +1,174 @@
+import sys
+
+import pytest
+
+from tap_google_analytics.client import Client
+from tap_google_analytics.error import GaInvalidArgumentError
+from tap_google_analytics.helpers import DATE_BATCHING_INTERVALS
+from tap_google_analytics.sync import batch_report_dates, get_query_groups, split_records
+
+from conftest import utc_date
+
+REPORTS = [
+    {'name': 'sessions', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:sessions', 'ga:users']},
+    {'name': 'pageviews', 'dimensions': ['ga:date', 'ga:source'], 'metrics': ['ga:pageviews']},
+    {'name': 'mediums', 'dimensions': ['ga:date', 'ga:medium'], 'metrics': ['ga:sessions']}
+]
+
+
+def make_stream(stream_id, dimensions, metrics, sync_ranges=(), **settings):
+    return {
+        'tap_stream_id': stream_id,
+        'schema': {'properties': {name: {} for name in dimensions + metrics + ['_sdc_record_hash']}},
+        'report_definition': {'dimensions': dimensions, 'metrics': metrics, 'filters': {}},
+        'sync_ranges': list(sync_ranges),
+        'settings': dict({'date_batching': 0, 'fixed_date_batching': False, 'sampling_level': None, 'segment_ids': [], 'segment_concurrency': None, 'priority': 0}, **settings)
+    }
+
+
+def records_by_stream(messages):
+    records = {}
+    for message in messages:
+        if message['type'] == 'RECORD':
+            record = {key: value for key, value in message['record'].items() if key != '_sdc_record_timestamp'}
+            records.setdefault(message['stream'], []).append(record)
+
+    return records
+
+
+def test_streams_with_the_same_dimensions_are_merged():
+    groups = get_query_groups([
+        make_stream('sessions', ['ga_date'], ['ga_sessions']),
+        make_stream('users', ['ga_date'], ['ga_users', 'ga_sessions']),
+        make_stream('sources', ['ga_date', 'ga_source'], ['ga_sessions']),
+        make_stream('sampled', ['ga_date'], ['ga_pageviews'], sampling_level='LARGE')
+    ])
+
+    assert [[stream['tap_stream_id'] for stream in group['streams']] for group in groups] == [['sessions', 'users'], ['sources'], ['sampled']]
+    assert groups[0]['metrics'] == ['ga_sessions', 'ga_users']
+
+
+def test_merged_metrics_stay_within_the_query_limit():
+    streams = [make_stream('stream{}'.format(i), ['ga_date'], ['ga_metric{}'.format(i * 4 + j) for j in range(4)]) for i in range(3)]
+
+    groups = get_query_groups(streams)
+
+    assert [len(group['metrics']) for group in groups] == [8, 4]
+    assert len(get_query_groups(streams, merge_streams=False)) == 3
+
+
+def test_split_records_keeps_the_stream_columns_and_nonzero_rows():
+    sessions = make_stream('sessions', ['ga_date'], ['ga_sessions'])
+    users = make_stream('users', ['ga_date'], ['ga_users'])
+    group = get_query_groups([sessions, users])[0]
+    records = [
+        {'ga_date': '20200101', 'ga_sessions': 1, 'ga_users': 0, '_sdc_record_hash': 'a'},
+        {'ga_date': '20200102', 'ga_sessions': 0, 'ga_users': 2, '_sdc_record_hash': 'b'}
+    ]
+
+    assert split_records(records, sessions, group) == [{'ga_date': '20200101', 'ga_sessions': 1, '_sdc_record_hash': 'a'}]
+    assert split_records(records, users, group) == [{'ga_date': '20200102', 'ga_users': 2, '_sdc_record_hash': 'b'}]
+
+
+def test_merged_streams_get_the_records_of_separate_queries(reporting_api, make_catalog, run_sync):
+    catalog = make_catalog(REPORTS)
+
+    merged_messages, exit_code = run_sync({}, {}, catalog)
+    assert exit_code == 0
+    merged_request_count = len(reporting_api.requests)
+
+    separate_messages, exit_code = run_sync({'merge_streams': False}, {}, catalog)
+    assert exit_code == 0
+
+    assert merged_request_count == 10
+    assert len(reporting_api.requests) - merged_request_count == 15
+    assert records_by_stream(merged_messages) == records_by_stream(separate_messages)
+
+
+def test_pages_are_written_before_the_next_one_is_fetched(reporting_api, make_catalog, run_sync, monkeypatch):
+    catalog = make_catalog(REPORTS[:2])
+    iterate_stream_pages = Client.iterate_stream_pages
+    written_around_pages = []
+
+    def iterate_single_record_pages(client, *args):
+        for page in iterate_stream_pages(client, *args):
+            for record in page:
+                written_before = sys.stdout.getvalue().count('"type": "RECORD"')
+                yield [record]
+                written_around_pages.append((written_before, sys.stdout.getvalue().count('"type": "RECORD"')))
+
+    monkeypatch.setattr(Client, 'iterate_stream_pages', iterate_single_record_pages)
+    messages, exit_code = run_sync({}, {}, catalog)
+
+    assert exit_code == 0
+    assert len(written_around_pages) == 15
+    assert all(written_after > written_before for written_before, written_after in written_around_pages)
+    assert sum(len(records) for records in records_by_stream(messages).values()) == written_around_pages[-1][1]
+
+
+@pytest.mark.parametrize('pipeline_queue_size', [None, 2])
+def test_rejected_merged_query_falls_back_to_separate_queries(reporting_api, make_catalog, run_sync, pipeline_queue_size):
+    catalog = make_catalog(REPORTS[:2])
+    expected_records = records_by_stream(run_sync({'merge_streams': False}, {}, catalog)[0])
+    reporting_api.requests.clear()
+
+    # ga:sessions and ga:pageviews are fine on their own, but not together
+    reporting_api.fail(GaInvalidArgumentError('Invalid metric combination'),
+                       lambda start_date, end_date, metrics: {'ga:sessions', 'ga:pageviews'} <= set(metrics))
+
+    state = {}
+    messages, exit_code = run_sync({'pipeline_queue_size': pipeline_queue_size}, state, catalog)
+
+    assert exit_code == 0
+    assert records_by_stream(messages) == expected_records
+    assert state['bookmarks']['sessions']['completed_ranges'] == [['2020-01-01', '2020-01-05']]
+    assert state['bookmarks']['pageviews']['completed_ranges'] == [['2020-01-01', '2020-01-05']]
+
+    # Only the first batch tries the merged query, the others go straight to separate queries
+    merged_requests = [request for request in reporting_api.requests if len(request[2]) == 3]
+    assert len(merged_requests) <= 1 + (pipeline_queue_size or 0)
+    assert len(reporting_api.requests) - len(merged_requests) == 10
+
+
+def test_short_ranges_are_batched_daily_unless_the_interval_is_fixed():
+    start_date, end_date = utc_date('2020-01-01'), utc_date('2020-01-10')
+    week = DATE_BATCHING_INTERVALS['WEEK']
+
+    assert len(list(batch_report_dates(start_date, end_date, week))) == 10
+    assert list(batch_report_dates(start_date, end_date, week, fixed_interval=True)) == [
+        (utc_date('2020-01-01'), utc_date('2020-01-07')),
+        (utc_date('2020-01-08'), utc_date('2020-01-10'))
+    ]
+    assert len(list(batch_report_dates(start_date, utc_date('2020-03-01'), week))) == 9
+
+
+def test_report_date_batching_applies_to_incremental_runs(reporting_api, make_catalog, run_sync):
+    catalog = make_catalog([
+        {'name': 'monthly', 'dimensions': ['ga:date'], 'metrics': ['ga:users'], 'date_batching': 'MONTH'},
+        {'name': 'daily', 'dimensions': ['ga:date'], 'metrics': ['ga:sessions']}
+    ])
+    state = {'bookmarks': {
+        'monthly': {'completed_ranges': [['2019-01-01', '2019-12-31']]},
+        'daily': {'completed_ranges': [['2019-01-01', '2019-12-31']]}
+    }}
+    config = {'start_date': utc_date('2019-01-01'), 'end_date': utc_date('2020-01-10'), 'date_batching': DATE_BATCHING_INTERVALS['MONTH']}
+
+    _, exit_code = run_sync(config, state, catalog)
+
+    assert exit_code == 0
+    # The last synced day is fetched again, even without a lookback
+    assert [request[:2] for request in reporting_api.requests if request[2] == ('ga:users',)] == [('2019-12-31', '2020-01-10')]
+    assert len([request for request in reporting_api.requests if request[2] == ('ga:sessions',)]) == 11
+
+
+@pytest.mark.parametrize('overrides', [{'date_batching': 'HOUR'}, {'lookback_days': -1}, {'view_id': '2'}, ['date_batching']])
+def test_invalid_overrides_edited_in_the_catalog_stop_the_sync(reporting_api, make_catalog, run_sync, overrides):
+    catalog = make_catalog(REPORTS[:1])
+    stream_metadata = next(entry['metadata'] for entry in catalog['streams'][0]['metadata'] if entry['breadcrumb'] == [])
+    stream_metadata['ga_overrides'] = overrides
+
+    messages, exit_code = run_sync({}, {}, catalog)
+
+    assert exit_code == 1
+    assert messages == []
+    assert reporting_api.requests == []
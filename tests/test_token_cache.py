@@ -0,0 +1,99 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from tap_google_analytics.token_cache import TokenCache
+
+
+class ExpiringCredentials:
+    def __init__(self, token=None, expiry=None):
+        self.token = token
+        self.expiry = expiry
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    """Replaces the calls to the token endpoint, which hand out token-1, token-2 and so on."""
+    refreshes = []
+
+    def refresh_credentials(credentials):
+        refreshes.append(credentials)
+        credentials.token = 'token-{}'.format(len(refreshes))
+        credentials.expiry = datetime.utcnow().replace(microsecond=0) + timedelta(hours=1)
+
+    monkeypatch.setattr('tap_google_analytics.token_cache.refresh_credentials', refresh_credentials)
+
+    return refreshes
+
+
+@pytest.fixture
+def cache_config(tmp_path):
+    return {
+        'token_cache': str(tmp_path / 'tokens.json'),
+        'oauth_credentials': {'client_id': 'client', 'refresh_token': 'refresh'}
+    }
+
+
+def test_token_caches_share_a_single_refresh(refreshes, cache_config):
+    credentials = [ExpiringCredentials() for _ in range(4)]
+    barrier = threading.Barrier(len(credentials))
+
+    def ensure_token(credentials):
+        # A TokenCache per thread, like separate tap processes
+        cache = TokenCache(cache_config)
+        barrier.wait()
+        cache.ensure_token(credentials)
+
+    threads = [threading.Thread(target=ensure_token, args=(c,)) for c in credentials]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(refreshes) == 1
+    assert {c.token for c in credentials} == {'token-1'}
+    assert len({c.expiry for c in credentials}) == 1
+
+
+def test_token_within_the_refresh_margin_is_refreshed(refreshes, cache_config):
+    cache = TokenCache(dict(cache_config, token_refresh_margin=600))
+    credentials = ExpiringCredentials('valid-token', datetime.utcnow() + timedelta(seconds=900))
+
+    cache.ensure_token(credentials)
+    assert credentials.token == 'valid-token'
+
+    credentials.expiry = datetime.utcnow() + timedelta(seconds=300)
+    cache.ensure_token(credentials)
+    assert credentials.token == 'token-1'
+    assert len(refreshes) == 1
+
+
+def test_cached_token_within_the_refresh_margin_is_not_reused(refreshes, cache_config):
+    expiry = datetime.utcnow() + timedelta(seconds=60)
+    with open(cache_config['token_cache'], 'w') as f:
+        json.dump({TokenCache(cache_config).key: {'token': 'cached-token', 'expiry': expiry.strftime('%Y-%m-%dT%H:%M:%S')}}, f)
+
+    credentials = ExpiringCredentials()
+    TokenCache(cache_config).ensure_token(credentials)
+
+    assert credentials.token == 'token-1'
+
+
+def test_corrupt_cache_file_is_replaced(refreshes, cache_config):
+    with open(cache_config['token_cache'], 'w') as f:
+        f.write('{"truncated": ')
+
+    credentials = ExpiringCredentials()
+    TokenCache(cache_config).ensure_token(credentials)
+
+    assert credentials.token == 'token-1'
+    with open(cache_config['token_cache']) as f:
+        assert list(json.load(f).values()) == [{'token': 'token-1', 'expiry': credentials.expiry.strftime('%Y-%m-%dT%H:%M:%S')}]
+
+    # The next process reuses the token written over the corrupt content
+    other_credentials = ExpiringCredentials()
+    TokenCache(cache_config).ensure_token(other_credentials)
+    assert other_credentials.token == 'token-1'
+    assert len(refreshes) == 1